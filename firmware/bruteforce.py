@@ -1,5 +1,8 @@
-from jltech.cipher import jl_enc_cipher, cipher_bytes
+from jltech.cipher import jl_enc_cipher, cipher_bytes, enc_prefix_table, enc_key_solver, sfc_keystream
+from jltech.keyindex import keyindex_build, KeyIndex
+from jltech.utils import anyint
 import argparse
+import os
 
 ################################################################################
 
@@ -12,13 +15,200 @@ ap.add_argument('reference',
 ap.add_argument('file',
                 help='File to bruteforce on (i.e. a flash dump, bfu file, etc)')
 
-ap.add_argument('offset',
-                help='Input file offset (i.e. tart of the encrypted area)')
+ap.add_argument('offset', nargs='?',
+                help='Input file offset (i.e. tart of the encrypted area), or where to start scanning from with --scan')
+
+ap.add_argument('--scan', action='store_true',
+                help='Locate the encrypted area by sliding the reference over the whole file, solving the key for each offset (requires NumPy)')
+
+ap.add_argument('--exhaustive', action='store_true',
+                help='Score all 65536 keys over the whole reference at once (requires NumPy)')
+
+ap.add_argument('--base', type=anyint,
+                help='Start of the encrypted area in the input file, if the reference is located somewhere within (default: same as offset)')
+
+ap.add_argument('--length', type=anyint, default=0x1000,
+                help='Maximum amount of reference data to score the keys against (default: %(default)d bytes)')
+
+ap.add_argument('--also', nargs=2, action='append', default=[], metavar=('REFERENCE', 'OFFSET'),
+                help='Additional reference file and its offset in the input file to score against (can be repeated)')
+
+ap.add_argument('--index', metavar='FILE',
+                help='Look the key up in the keystream index file (made by mkkeyindex.py, or created there if missing), '
+                     'using a single 32-byte block of reference')
+
+ap.add_argument('--top', type=int, default=5,
+                help='Number of the best key candidates to report (default: %(default)d)')
 
 args = ap.parse_args()
 
 ################################################################################
 
+def exhaustive_search(np, fpath, refs, base, maxlen):
+    """ Score every key against the references, using the SFC address-derived key schedule """
+    # first 32 keystream bytes for every key
+    table = np.frombuffer(enc_prefix_table(), np.uint8).reshape(0x10000, 32)
+
+    # histogram of the expected keystream bytes at each position within a block
+    hist = np.zeros((32, 256), np.int32)
+    total = 0
+
+    with open(fpath, 'rb') as f:
+        for rpath, offset in refs:
+            with open(rpath, 'rb') as rf:
+                ref = rf.read(maxlen)
+
+            f.seek(offset)
+            src = f.read(len(ref))
+
+            pos = np.arange(len(src)) + (offset - base)
+            blk = pos >> 5
+            idx = pos & 31
+
+            # block n is keyed by (key ^ n*8), and since the keystream is linear:
+            # ENC(key)[i] == src ^ ref ^ ENC(n*8)[i]
+            want = (np.frombuffer(src, np.uint8) ^ np.frombuffer(ref[:len(src)], np.uint8)
+                        ^ table[(blk * 8) & 0xFFFF, idx])
+
+            np.add.at(hist, (idx, want), 1)
+            total += len(src)
+
+    if total == 0:
+        raise ValueError('Nothing to score the keys against')
+
+    scores = hist[np.arange(32), table].sum(axis=1)
+    return scores, total
+
+def scan_search(np, dump, ref, start=0):
+    """ Solve the key for every 4-byte aligned offset where the reference might start,
+        and check whether the SFC area starting there gives the reference contents """
+    table = np.frombuffer(enc_prefix_table(), np.uint8).reshape(0x10000, 32)
+    lo8, hiinv = (np.frombuffer(t, np.uint8) for t in enc_key_solver())
+
+    data = np.frombuffer(dump, np.uint8)
+    head = np.frombuffer(ref[:32], np.uint8)
+
+    count = (len(dump) - 32 - start) // 4 + 1
+    if count <= 0:
+        return []
+
+    def keystream_at(i):
+        # the would-be keystream byte i for all offsets
+        return data[start + i : start + i + count * 4 : 4] ^ head[i]
+
+    # keystream byte 0 is the key's lower half, byte 8 gives away the upper half
+    ks0 = keystream_at(0)
+    keys = (hiinv[keystream_at(8) ^ lo8[ks0]].astype(np.int32) << 8) | ks0
+
+    # weed out the offsets where the remaining bytes of the first block don't agree
+    cand = np.arange(count)
+    for i in (16, 24, 4, 12, 20, 28):
+        cand = cand[table[keys[cand], i] == keystream_at(i)[cand]]
+
+    cand = [c for c in cand
+                if (data[start + c*4 : start + c*4 + 32] ^ head == table[keys[c]]).all()]
+
+    found = []
+
+    for c in cand:
+        off = start + c * 4
+        key = int(keys[c])
+
+        # now check it against the whole reference with the SFC key schedule
+        size = min(len(ref), len(dump) - off)
+        plain = np.frombuffer(sfc_keystream(key, 0, size), np.uint8) ^ data[off : off + size]
+        diff = np.nonzero(plain != np.frombuffer(ref, np.uint8)[:size])[0]
+
+        found.append((off, off + (diff[0] if len(diff) else size), key))
+
+    return found
+
+################################################################################
+
+if args.scan:
+    import numpy as np
+
+    with open(args.file, 'rb') as f:
+        dump = f.read()
+
+    with open(args.reference, 'rb') as f:
+        ref = f.read()
+
+    if len(ref) < 32:
+        print('The reference should be at least 32 bytes long')
+        exit(1)
+
+    found = scan_search(np, dump, ref, 0 if args.offset is None else anyint(args.offset))
+
+    if len(found) == 0:
+        print('The reference has not been found')
+        exit(1)
+
+    # the longest matches first
+    found.sort(key=lambda f: f[0] - f[1])
+
+    for start, end, key in found[:args.top]:
+        print('@%08X - @%08X (%d of %d bytes): key %04X' % (start, end, end - start, len(ref), key))
+
+    start, end, key = found[0]
+    print("Possibly it's >>>> %04X <<<< with the encrypted area at @%X" % (key, start))
+
+    exit(0)
+
+if args.offset is None:
+    ap.error('the offset argument is required')
+
+if args.index is not None:
+    offset = anyint(args.offset)
+    base = offset if args.base is None else args.base
+
+    if (offset - base) % 32:
+        print('The offset should point to the beginning of a 32-byte block relative to the base')
+        exit(1)
+
+    if not os.path.exists(args.index):
+        print(f'Building the index file "{args.index}"...')
+        keyindex_build(args.index)
+
+    with open(args.file, 'rb') as f:
+        f.seek(offset)
+        src = f.read(32)
+
+    with open(args.reference, 'rb') as f:
+        ref = f.read(32)
+
+    keys = KeyIndex(args.index).recover(src, ref, (offset - base) >> 2)
+
+    if len(keys) == 0:
+        print('No key matches this block')
+    else:
+        print('Found:', ' '.join(['%04X' % key for key in keys]))
+        print("It's >>>> %04X <<<<" % keys[0])
+
+    exit(0)
+
+if args.exhaustive:
+    import numpy as np
+
+    offset = anyint(args.offset)
+    base = offset if args.base is None else args.base
+
+    refs = [(args.reference, offset)] + [(r, anyint(o)) for r, o in args.also]
+
+    scores, total = exhaustive_search(np, args.file, refs, base, args.length)
+
+    ranked = np.argsort(scores, kind='stable')[::-1][:args.top]
+
+    for key in ranked:
+        print('%04X: %6d / %d bytes matched (%.1f%%)' % (key, scores[key], total, scores[key] * 100 / total))
+
+    best = ranked[0]
+    runnerup = scores[ranked[1]] if len(ranked) > 1 else 0
+    print("Possibly it's >>>> %04X <<<< (confidence %.1f%%, %d bytes ahead of the next one)" %
+            (best, scores[best] * 100 / total, scores[best] - runnerup))
+
+    exit(0)
+
 with open(args.file, 'rb') as f:
     f.seek(int(args.offset, 0))
     src = f.read(32)
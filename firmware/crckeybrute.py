@@ -0,0 +1,64 @@
+from jltech.cipher import jl_crc_cipher, crc_recover_keys, cipher_bytes
+from jltech.crc import jl_crc16
+from jltech.utils import anyint
+import argparse
+import struct
+
+################################################################################
+
+ap = argparse.ArgumentParser(description='JieLi CrcDecode key bruteforce')
+
+ap.add_argument('--reference',
+                help='Reference file with the expected contents at the offset')
+
+ap.add_argument('--length', type=anyint, default=64,
+                help='Amount of the reference data to check the keys against (default: %(default)d bytes)')
+
+ap.add_argument('--header-crc', type=anyint, metavar='SIZE',
+                help='Check the deciphered data for a header of the specified size that starts with a CRC16 of its remaining part (e.g. 32 for a SYD header)')
+
+ap.add_argument('--low', type=anyint, default=0xFFFF,
+                help='Lower half of the keys to report (default: 0x%(default)04X)')
+
+ap.add_argument('file',
+                help='File to bruteforce on')
+
+ap.add_argument('offset', type=anyint, nargs='?', default=0,
+                help='Offset of the ciphered data in the file (default: %(default)d)')
+
+args = ap.parse_args()
+
+################################################################################
+
+if args.reference is None and args.header_crc is None:
+    ap.error('either the reference or the header CRC check is required')
+
+with open(args.file, 'rb') as f:
+    f.seek(args.offset)
+    src = f.read(max(args.length, args.header_crc or 0))
+
+if args.reference is not None:
+    with open(args.reference, 'rb') as f:
+        ref = f.read(args.length)
+
+    size = min(len(src), len(ref))
+    keys = crc_recover_keys(bytes(a ^ b for a, b in zip(src[:size], ref[:size])), args.low)
+else:
+    # everything is a candidate then
+    keys = [(high << 16) | args.low for high in range(0x10000)]
+
+if args.header_crc is not None:
+    def header_ok(key):
+        hdr = cipher_bytes(jl_crc_cipher, src[:args.header_crc], key)
+        hcrc, = struct.unpack_from('<H', hdr)
+        return jl_crc16(hdr[2:]) == hcrc
+
+    keys = [key for key in keys if header_ok(key)]
+
+if len(keys) == 0:
+    print("Wasn't able to pick a key")
+    exit(1)
+
+print('Found:', ' '.join(['%08X' % key for key in keys]))
+print("Possibly it's >>>> %08X <<<<" % keys[0])
+print('(any other key with the same CRC16 of its upper half, with the lower half as the initial value, works the same)')
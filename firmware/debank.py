@@ -1,6 +1,6 @@
-from jltech.cipher import jl_enc_cipher, cipher_bytes
-from jltech.crc import jl_crc16
-import struct, argparse
+from jltech.bankcb import BankCB, bankcb_find_key, bankcb_extract_file
+import argparse
+import mmap
 from pathlib import Path
 
 ############################################################
@@ -19,83 +19,52 @@ ap.add_argument('--offset', type=anyint, default=0,
 ap.add_argument('--bigendian', action='store_true',
                 help='Treat the multi-byte fields in big-endian instead of little endian')
 
+ap.add_argument('--jobs', type=int, default=1, metavar='N',
+                help='Extract the banks with N worker processes (0 = one per CPU)')
+
 ap.add_argument('file', type=Path,
                 help='Input file')
 
-args = ap.parse_args()
-
 ############################################################
 
-with open(args.file, 'rb') as f:
+if __name__ == '__main__':
+    args = ap.parse_args()
+
     bcoffset = args.offset
     key = args.key
-
-    def read(off, size):
-        f.seek(bcoffset + off)
-        data = f.read(size)
-        if key is not None:
-            data = cipher_bytes(jl_enc_cipher, data, key=key)
-        return data
-
-    ######################################
-
     endian = '>' if args.bigendian else '<'
 
-    if key is not None:
-        oldkey = key
-        didit = False
-
-        for i in range(0x10000):
-            key = oldkey ^ i
+    with open(args.file, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if key is not None:
+                # the header CRC weeds out almost everything, then the bank data CRC
+                # is checked for the rest, starting from the closest to the given key
+                realkey = bankcb_find_key(mm, bcoffset, key, endian)
 
-            bhdr, bhcrc = struct.unpack(endian + '14sH', read(0, 16))
+                if realkey is None:
+                    print("Wasn't able to pick a key")
+                elif realkey != key:
+                    print('The real key is: %04x' % realkey)
+                    key = realkey
+                else:
+                    print('The key seems to be correct')
 
-            if jl_crc16(bhdr) != bhcrc:
-                continue
+            # the bank count in the first header seems to be inclusive
+            bcb = BankCB(mm, bcoffset, key, endian, inclusive=True)
 
-            bidx, bsize, bload, boff, bcrc = struct.unpack(endian + 'HHIIH', bhdr)
-
-            data = read(boff, bsize)
-            if jl_crc16(data) == bcrc:
-                didit = True
-                break
-
-        if didit:
-            if key != oldkey:
-                print('The real key is: %04x' % key)
-            else:
-                print('The key seems to be correct')
-        else:
-            print("Wasn't able to pick a key")
-            key = oldkey
+            for ent in bcb:
+                print('%2d: @%-8x -> @%-8x (%-5d) | %04x' % (ent.index, ent.offset, ent.load, ent.size, ent.crc))
 
     ############################################################################################
 
     outdir : Path = args.file.parent / (args.file.name + '_banks_%x' % bcoffset)
     outdir.mkdir(exist_ok=True)
 
-    bankidx = 0
-    bankcnt = 0
-
-    while bankidx <= bankcnt:
-        bhdr, bhcrc = struct.unpack(endian + '14sH', read(bankidx * 16, 16))
-        if jl_crc16(bhdr) != bhcrc:
-            if bankidx == bankcnt:
-                break # ignore for the last bank - may be an inclusive bank count
-            raise ValueError('Invalid bank %d header CRC' % bankidx)
-
-        bidx, bsize, bload, boff, bcrc = struct.unpack(endian + 'HHIIH', bhdr)
-        print('%2d: @%-8x -> @%-8x (%-5d) | %04x' % (bidx, boff, bload, bsize, bcrc))
-
-        # the first bank entry defines the total bank count
-        if bankidx == 0:
-            bankcnt = bidx
-
-        data = read(boff, bsize)
-        if jl_crc16(data) != bcrc:
-            raise ValueError('Bank %d data CRC mismatch' % bankidx)
-
-        (outdir / ('bank_%d_%x.bin' % (bidx, bload))).write_bytes(data)
+    files = [(i, outdir / ('bank_%d_%x.bin' % (ent.index, ent.load))) for i, ent in enumerate(bcb)]
 
-        bankidx += 1
+    res = bankcb_extract_file(args.file, files, bcoffset, key, endian, inclusive=True,
+                              workers=args.jobs if args.jobs > 0 else None)
 
+    for i, ok in enumerate(res):
+        if not ok:
+            raise ValueError('Bank %d data CRC mismatch' % i)
@@ -1,13 +1,18 @@
 from jltech.crc import jl_crc16
-from jltech.cipher import jl_enc_cipher, jl_sfc_cipher, cipher_bytes
+from jltech.cipher import jl_enc_cipher, enc_keystream, sfc_decrypt_region, cipher_bytes
+from jltech.bankcb import BankCB
 from jltech.chipkeybin import chipkeybin_decode
-from jltech.utils import hexdump, nulltermstr
+from jltech.utils import nulltermstr
+from jltech.report import *
+from jltech.batch import batch_main
 
 from pathlib import Path
 
 import argparse
 import struct
+import mmap
 import yaml
+import io
 
 ###################################################################################################
 
@@ -17,14 +22,19 @@ ap.add_argument('--dirname', default='{fpath}_unpack',
                 help='Unpack directory name template, default: "%(default)s".'
                      ' ({fpath} refers to the full file path, {fdir} refers to the directory name the file resides in, {fname} refers to the file name)')
 
+ap.add_argument('--jobs', type=int, default=1, metavar='N',
+                help='Unpack the files with N worker processes (0 = one per CPU), each file\'s log going into a .log file named after its unpack directory')
+
+report_add_args(ap)
+
 ap.add_argument('file', type=Path, nargs='+',
                 help='Input firmware file(s)')
 
-args = ap.parse_args()
-
 ###################################################################################################
 
 class SYDFile:
+    __slots__ = ('sydfs', 'type', 'crc16', 'offset', 'size', 'number', 'name', 'absoffset')
+
     def __init__(self, sydfs, _type, _crc16, _offset, _size, _number, _name:str):
         self.sydfs = sydfs
 
@@ -44,12 +54,17 @@ class SYDFile:
         remsize = min(size, self.size - addr)
         return self.sydfs.flash.read(self.absoffset + addr, remsize)
 
+    def info(self):
+        return dict(name=self.name, size=self.size, offset=self.offset, crc16=self.crc16, type=self.type, number=self.number)
+
     def __repr__(self):
         return '<[%-16s]: %8d bytes @ %08x - CRC 0x%04x, type %d, #%d>' % \
                 (self.name, self.size, self.offset, self.crc16, self.type, self.number)
 
 
 class SYDReader:
+    entry_fmt = '<BBHIII16s'
+
     def __init__(self, flash, flashbase=0, headerbase=0, encrypted=True, size=None, headerless=False):
         self.flash = flash
         self.flash_base = flashbase
@@ -64,19 +79,15 @@ class SYDReader:
 
             self.list_base = self.header_base
 
-            self.filelist = []
-
-            for off in range(0, size, 32):
-                entry = flash.read(self.list_base + off, 32)
+            flist = flash.read(self.list_base, (size + 31) & ~31)
+            self.entries = list(struct.iter_unpack(self.entry_fmt, flist[:len(flist) & ~31]))
 
+            for i, ent in enumerate(self.entries):
                 # TODO, proper sanity check
-                if entry[1] != 0x00:
+                if ent[1] != 0x00:
+                    del self.entries[i:]
                     break
 
-                self.filelist.append(entry)
-
-            self.file_count = len(self.filelist)
-
         else:
             fhead = flash.read(self.header_base, 32)
             if encrypted: fhead = cipher_bytes(jl_enc_cipher, fhead)
@@ -89,28 +100,36 @@ class SYDReader:
 
             flcrc, finfo1, finfo2, fnum, fver, fver1, fctype = struct.unpack('<HIIIII8s', fhead)
 
-            print('<SYD> list crc: %04x, Info: %08x %08x, count: %d, version: %08x %08x, chiptype: %s' % \
-                  (flcrc, finfo1, finfo2, fnum, fver, fver1, fctype))
+            log('<SYD> list crc: %04x, Info: %08x %08x, count: %d, version: %08x %08x, chiptype: %s' % \
+                (flcrc, finfo1, finfo2, fnum, fver, fver1, fctype))
+            event('syd', offset=self.header_base, list_crc=flcrc, info=[finfo1, finfo2], count=fnum,
+                  version=[fver, fver1], chiptype=fctype)
 
             if fnum > 1024:
                 raise Exception('Too ambigous file count')
 
-            self.file_count = fnum
-
             self.h_info     = (finfo1, finfo2)
             self.h_version  = (fver, fver1)
             self.h_chiptype = fctype
 
-            flist = flash.read(self.list_base, self.file_count * 32)
+            flist = flash.read(self.list_base, fnum * 32)
 
             if jl_crc16(flist) != flcrc:
                 raise Exception('File list CRC mismatch')
 
-            self.filelist = []
-            for i in range(self.file_count):
-                entry = flist[i * 32 : i * 32 + 32]
-                if encrypted: entry = cipher_bytes(jl_enc_cipher, entry)
-                self.filelist.append(entry)
+            if len(flist) != fnum * 32:
+                raise Exception('File list goes beyond the flash')
+
+            # every entry is enciphered on its own, i.e. with the same keystream
+            if encrypted and fnum > 0:
+                ks = enc_keystream(0xFFFF, 32) * fnum
+                flist = (int.from_bytes(flist, 'little') ^ int.from_bytes(ks, 'little')).to_bytes(len(flist), 'little')
+
+            self.entries = list(struct.iter_unpack(self.entry_fmt, flist))
+
+        self.file_count = len(self.entries)
+        self._files = [None] * self.file_count
+        self._names = None
 
     #-------------------------------------------------#
 
@@ -118,21 +137,35 @@ class SYDReader:
         if fid < 0 or fid >= self.file_count:
             raise IndexError('File ID out of bounds')
 
-        #entry = self.flash.read(self.list_base + 32 * fid, 32)
-        #if self.encrypted: entry = jl_crypt_enc(entry)
+        ent = self._files[fid]
 
-        etype, eres, ecrc16, eoff, elen, enum, ename = struct.unpack('<BBHIII16s', self.filelist[fid])
+        if ent is None:
+            etype, eres, ecrc16, eoff, elen, enum, ename = self.entries[fid]
 
-        ename = nulltermstr(ename, 'ascii')
+            ent = self._files[fid] = SYDFile(self,
+                _type     = etype,
+                _crc16    = ecrc16,
+                _offset   = eoff,
+                _size     = elen,
+                _number   = enum,
+                _name     = nulltermstr(ename, 'ascii')
+            )
 
-        return SYDFile(self,
-            _type     = etype,
-            _crc16    = ecrc16,
-            _offset   = eoff,
-            _size     = elen,
-            _number   = enum,
-            _name     = ename
-        )
+        return ent
+
+    def get_file(self, name):
+        """ Look up a file by its name (the last one wins if there are several), None if there's no such file """
+        if self._names is None:
+            self._names = {nulltermstr(ent[6]): i for i, ent in enumerate(self.entries)}
+
+        fid = self._names.get(name.encode('ascii', errors='replace'))
+        return None if fid is None else self.get_file_by_id(fid)
+
+    def __len__(self):
+        return self.file_count
+
+    def __iter__(self):
+        return (self.get_file_by_id(i) for i in range(self.file_count))
 
 ####################################################################
 
@@ -140,13 +173,21 @@ class FlashFile:
     def __init__(self, file, offset=0, size=None):
         self.file = file
         self.offset = offset
+        self.map = None
+
+        filesize = file.seek(0, 2)
 
         if size is not None:
             self.size = size
         else:
-            oldpos = file.tell()
-            self.size = file.seek(0, 2) - self.offset
-            file.seek(oldpos)
+            self.size = filesize - self.offset
+
+        # map the whole file if possible, so that the reads are merely slices of it
+        if filesize > 0:
+            try:
+                self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError, io.UnsupportedOperation):
+                pass
 
     def read(self, addr, size):
         #if addr >= self.size:
@@ -155,9 +196,21 @@ class FlashFile:
         #    raise ValueError('Reading way out of bounds')
 
         #print("\x1b[1;33m  ;; flash read - %08x %d ;;\x1b[0m" % (addr, size))
-        self.file.seek(self.offset + addr)
+        off = self.offset + addr
+        if off < 0:
+            raise ValueError('Reading before the beginning of the file')
+
+        if self.map is not None:
+            return self.map[off : off+size]
+
+        self.file.seek(off)
         return self.file.read(size)
 
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
 class SFCMap:
     def __init__(self, flash, base, key):
         self.flash = flash
@@ -169,25 +222,48 @@ class SFCMap:
 
         self.size = flash.size - base
 
+        # deciphered contents, filled in on demand, with a flag for each 32-byte block done
+        self.shadow = bytearray(self.size)
+        self.done = bytearray((self.size + 0x1F) >> 5)
+
     def read(self, addr, size):
-        baddr = addr & ~0x1F
-        bsize = addr + size - baddr
+        end = min(addr + size, self.size)
+        if addr < 0 or addr >= end:
+            return b''
+
+        blk = addr >> 5
+        blkend = (end + 0x1F) >> 5
 
-        data = bytearray(self.flash.read(self.base + baddr, bsize))
+        # decipher the runs of blocks that were not touched yet
+        while True:
+            blk = self.done.find(0, blk, blkend)
+            if blk < 0:
+                break
 
-        jl_sfc_cipher(data, 0, len(data), -baddr, self.key)
+            runend = self.done.find(1, blk, blkend)
+            if runend < 0:
+                runend = blkend
 
-        return bytes(data[addr-baddr:])
+            off = blk << 5
+            data = self.flash.read(self.base + off, min(runend << 5, self.size) - off)
+
+            self.shadow[off : off+len(data)] = data
+            sfc_decrypt_region(self.shadow, 0, self.key, off, len(data))
+            self.done[blk:runend] = b'\1' * (runend - blk)
+
+            blk = runend
+
+        return bytes(self.shadow[addr:end])
 
 ###################################################################################################
 
 def chipkeyfile_decode(ent):
-    print('---- Chip key file ----')
+    log('---- Chip key file ----', level=VERBOSE)
 
     ckfile = ent.read(0, ent.size)
 
-    print('(as specified by the file entry)')
-    hexdump(ckfile)
+    log('(as specified by the file entry)', level=VERBOSE)
+    dump(ckfile)
 
     if jl_crc16(ckfile) != ent.crc16:
         raise Exception('Chipkey file CRC mismatch (from file entry!)')
@@ -195,8 +271,8 @@ def chipkeyfile_decode(ent):
     # there are some extra data that goes after this file entry (32 bytes)
     ckfile = ent.sydfs.flash.read(ent.absoffset, 64)
 
-    print('(extra data)')
-    hexdump(ckfile)
+    log('(extra data)', level=VERBOSE)
+    dump(ckfile)
 
     ckdata, ckcrc = struct.unpack_from('<32sH', ckfile, 0)
 
@@ -205,8 +281,9 @@ def chipkeyfile_decode(ent):
 
     key = chipkeybin_decode(ckdata)
 
-    print(f'>>> Chip key: 0x{key:04X} <<<')
-    print('------------------------')
+    log(f'>>> Chip key: 0x{key:04X} <<<')
+    log('------------------------', level=VERBOSE)
+    event('chipkey', key=key)
 
     return key
 
@@ -214,40 +291,24 @@ def chipkeyfile_decode(ent):
 
 def bankcb_decrypt(data, key=0xffff):
     data = bytearray(data)
-
-    def derange(off, len):
-        de = cipher_bytes(jl_enc_cipher, data[off:off+len], key=key)
-        data[off:off+len] = de
-        return de
-
     base = 0
 
     while base < len(data):
-        print('=== bankcb @ %x' % base)
-
-        i = 0
-        banks = 1
-        maxend = 0
-
-        while i < banks:
-            bhdr, bhcrc = struct.unpack('<14sH', derange(base + i*16, 16))
-            if jl_crc16(bhdr) != bhcrc:
-                raise Exception('CRC mismatch for a bank %d header at %x' % (i, base))
+        log('=== bankcb @ %x' % base)
 
-            bnum, bsize, bload, boff, bcrc = struct.unpack('<HHIIH', bhdr)
-            print('  #%d (%d) @=>%x @%x - %04x / %04x' % (bnum, bsize, bload, boff, bcrc, bhcrc))
+        bcb = BankCB(data, base, key)
+        event('bankcb', offset=base, banks=len(bcb))
 
-            maxend = max(maxend, boff + bsize)
+        for ent in bcb:
+            log('  #%d (%d) @=>%x @%x - %04x / %04x' % (ent.index, ent.size, ent.load, ent.offset, ent.crc, ent.hcrc))
+            event('bank', **ent._asdict())
 
-            if i == 0: banks = bnum
+        # decipher the headers and banks in place, checking the CRC along the way
+        bad = bcb.decipher_into(data)
+        if bad:
+            raise Exception('CRC mismatch for a bank %d data to be loaded at %x, at %x' % (bad[0], bcb[bad[0]].load, base))
 
-            bdata = derange(base + boff, bsize)
-            if jl_crc16(bdata) != bcrc:
-                raise Exception('CRC mismatch for a bank %d data to be loaded at %x, at %x' % (i, bload, base))
-
-            i += 1
-
-        base += maxend
+        base += bcb.size
 
     return bytes(data)
 
@@ -256,6 +317,12 @@ def bankcb_decrypt(data, key=0xffff):
 def parsefw(fwfile, outdir:Path):
     flash = FlashFile(fwfile)
 
+    try:
+        parseflash(flash, outdir)
+    finally:
+        flash.close()
+
+def parseflash(flash, outdir:Path):
     #====================================================================#
 
     f_uboot = None
@@ -277,12 +344,14 @@ def parsefw(fwfile, outdir:Path):
         if fw_pdc is None:
             if block.startswith(b'pdc:'):
                 fw_pdc = block[4:]
-                print('--- PDC-> [%s]' % fw_pdc)
+                log('--- PDC-> [%s]' % fw_pdc)
+                event('pdc', value=fw_pdc)
 
         elif fw_pdn is None:
             if block.startswith(b'pdn:'):
                 fw_pdn = nulltermstr(block[4:], encoding='ascii')
-                print('--- PDN-> [%s]' % fw_pdn)
+                log('--- PDN-> [%s]' % fw_pdn)
+                event('pdn', value=fw_pdn)
 
         else:
             break
@@ -296,46 +365,32 @@ def parsefw(fwfile, outdir:Path):
     #
     fwsyd = SYDReader(flash)
 
-    for n in range(fwsyd.file_count):
-        ent = fwsyd.get_file_by_id(n)
-
-        print(ent)
-
-        if ent.name == 'uboot.boot':
-            f_uboot = ent
+    for ent in fwsyd:
+        log(ent)
+        event('syd_entry', **ent.info())
 
-        #elif ent.name == 'user.app':
-        #    f_userapp = ent
+    f_uboot = fwsyd.get_file('uboot.boot')
 
-        elif ent.name == '_____.____2':
-            info2syd = SYDReader(flash, headerbase=ent.absoffset, encrypted=False, size=ent.size, headerless=True)
+    #f_userapp = fwsyd.get_file('user.app')
 
-            for m in range(info2syd.file_count):
-                ent = info2syd.get_file_by_id(m)
+    info2 = fwsyd.get_file('_____.____2')
+    if info2 is not None:
+        info2syd = SYDReader(flash, headerbase=info2.absoffset, encrypted=False, size=info2.size, headerless=True)
 
-                if ent.name == 'ver.bin':
-                    f_verbin = ent
-
-                elif ent.name == 'user.app':
-                    f_userapp = ent
-
-                elif ent.name == 'sys.cfg':
-                    f_syscfg = ent
-
-                elif ent.name == 'spc.aer':
-                    f_spcaer = ent
-
-                elif ent.name == 'chip_key.bin':
-                    f_chipkey = ent
+        f_verbin  = info2syd.get_file('ver.bin')
+        f_userapp = info2syd.get_file('user.app')
+        f_syscfg  = info2syd.get_file('sys.cfg')
+        f_spcaer  = info2syd.get_file('spc.aer')
+        f_chipkey = info2syd.get_file('chip_key.bin')
 
     #====================================================================#
 
-    print('uboot.boot file:  ', f_uboot)
-    print('user.app file:    ', f_userapp)
-    print('sys.cfg file:     ', f_syscfg)
-    print('spc.aer file:     ', f_spcaer)
-    print('chipkey.bin file: ', f_chipkey)
-    print('ver.bin file:     ', f_verbin)
+    log('uboot.boot file:  ', f_uboot)
+    log('user.app file:    ', f_userapp)
+    log('sys.cfg file:     ', f_syscfg)
+    log('spc.aer file:     ', f_spcaer)
+    log('chipkey.bin file: ', f_chipkey)
+    log('ver.bin file:     ', f_verbin)
 
     #
     # kind of a sanity check
@@ -393,7 +448,7 @@ def parsefw(fwfile, outdir:Path):
     try:
         chipkey = chipkeyfile_decode(f_chipkey)
 
-        print('Using chipkey: %04x' % chipkey)
+        log('Using chipkey: %04x' % chipkey)
         fwinfo['chipkey'] = chipkey
 
         # SFC is mapped at the beginning of user.app
@@ -405,11 +460,11 @@ def parsefw(fwfile, outdir:Path):
         syscfg = sfc.read(f_syscfg.offset - f_userapp.offset, f_syscfg.size)
 
         if jl_crc16(syscfg) != f_syscfg.crc16:
-            print('Syscfg CRC mismatch')
+            log('Syscfg CRC mismatch', level=QUIET)
             return
 
-        print('######### sys.cfg:')
-        hexdump(syscfg)
+        log('######### sys.cfg:', level=VERBOSE)
+        dump(syscfg)
 
         '''
         sys.cfg layout:
@@ -442,33 +497,33 @@ def parsefw(fwfile, outdir:Path):
 
         # Flash config
         flashcfg = struct.unpack_from('<IIIIIIIIII', syscfg, 0)
-        print('flash_id         = 0x%x' % flashcfg[0])
-        print('flash_size       = %d'   % flashcfg[1])
-        print('flash_file_size  = %d'   % flashcfg[2])
-        print('sdfile_head_addr = 0x%x' % flashcfg[3])
-        print('spi_run_mode     = 0x%x' % flashcfg[4])
-        print('spi_div          = %d'   % flashcfg[5])
-        print('flash_base       = 0x%x' % flashcfg[6])
-        print('protected_arg    = 0x%x' % flashcfg[7])
-        print('cfg_zone_addr    = 0x%x' % flashcfg[8])
-        print('cfg_zone_size    = %d'   % flashcfg[9])
-        print()
+        log('flash_id         = 0x%x' % flashcfg[0])
+        log('flash_size       = %d'   % flashcfg[1])
+        log('flash_file_size  = %d'   % flashcfg[2])
+        log('sdfile_head_addr = 0x%x' % flashcfg[3])
+        log('spi_run_mode     = 0x%x' % flashcfg[4])
+        log('spi_div          = %d'   % flashcfg[5])
+        log('flash_base       = 0x%x' % flashcfg[6])
+        log('protected_arg    = 0x%x' % flashcfg[7])
+        log('cfg_zone_addr    = 0x%x' % flashcfg[8])
+        log('cfg_zone_size    = %d'   % flashcfg[9])
+        log()
 
         # Clock config
         clkcfg = struct.unpack_from('<IIIII', syscfg, 10*4)
-        print('pll_sel          = %d'   % clkcfg[0])
-        print('osc_freq         = %d'   % clkcfg[1])
-        print('osc_src          = %d'   % clkcfg[2])
-        print('osc_hc_en        = %d'   % clkcfg[3])
-        print('osc_1pin_en      = %d'   % clkcfg[4])
-        print()
+        log('pll_sel          = %d'   % clkcfg[0])
+        log('osc_freq         = %d'   % clkcfg[1])
+        log('osc_src          = %d'   % clkcfg[2])
+        log('osc_hc_en        = %d'   % clkcfg[3])
+        log('osc_1pin_en      = %d'   % clkcfg[4])
+        log()
 
         # Whatever
         watcfg = struct.unpack_from('<II', syscfg, 15*4)
-        print('rem stuff start  = 0x%x' % watcfg[0])
-        print('rem stuff length = 0x%x' % watcfg[1])
-        print(' ---> %08x' % (watcfg[0] + watcfg[1]))
-        print()
+        log('rem stuff start  = 0x%x' % watcfg[0])
+        log('rem stuff length = 0x%x' % watcfg[1])
+        log(' ---> %08x' % (watcfg[0] + watcfg[1]))
+        log()
 
         fwinfo['system_config'] = dict(
             flash_cfg = dict(
@@ -504,10 +559,13 @@ def parsefw(fwfile, outdir:Path):
             )
         )
 
-        print('cfg zone:')
-        hexdump(flash.read(flashcfg[8] + flashcfg[6], flashcfg[9]))
+        event('syscfg', **fwinfo['system_config'])
+
+        if report_enabled(VERBOSE):
+            log('cfg zone:', level=VERBOSE)
+            dump(flash.read(flashcfg[8] + flashcfg[6], flashcfg[9]))
 
-        print('######### user.app:')
+        log('######### user.app:')
 
         #
         # finally extract data from the user.app, whose syd header starts with offset specified in sys.cfg
@@ -520,23 +578,24 @@ def parsefw(fwfile, outdir:Path):
 
         fwinfo['app_files'] = []
 
-        for mm in range(appsyd.file_count):
-            ent = appsyd.get_file_by_id(mm)
-
-            print(ent)
-            hexdump(ent.read(0, 0x40))
+        for ent in appsyd:
+            log(ent)
 
             data = ent.read(0, ent.size)
-            if jl_crc16(data) != ent.crc16:
-                print('Warning: CRC16 does not match!')
+            dump(data[:0x40], level=DEBUG)
+
+            crcok = jl_crc16(data) == ent.crc16
+            if not crcok:
+                log(f'Warning: CRC16 does not match for "{ent.name}" @{ent.offset:x}!', level=QUIET)
 
             outfile = appdatadir/ent.name
             outfile.write_bytes(data)
 
             fwinfo['app_files'].append(str(outfile.relative_to(yamlpath.parent)))
+            event('app_file', **ent.info(), crc_ok=crcok, path=outfile)
 
     except Exception as e:
-        print('<!> Failed to parse user app:', e)
+        log('<!> Failed to parse user app:', e, level=QUIET)
 
     #
     # dump the firmware info!
@@ -546,16 +605,10 @@ def parsefw(fwfile, outdir:Path):
 
 ###################################################################################################
 
-for fpath in args.file:
-    print(f'#\n# {fpath}\n#\n')
-
-    try:
-        with open(fpath, 'rb') as f:
-            parsefw(f,
-                Path(args.dirname.format(fpath=fpath, fname=fpath.name, fdir=fpath.parent))
-            )
-
-    except Exception as e:
-        print('[!] Failed:', e)
+def unpack(fpath, outdir:Path):
+    with open(fpath, 'rb') as f:
+        parsefw(f, outdir)
 
-    print()
+if __name__ == '__main__':
+    args = ap.parse_args()
+    batch_main(args, unpack, args.file)
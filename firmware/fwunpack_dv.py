@@ -1,7 +1,11 @@
 from jltech.cipher import jl_enc_cipher, cipher_bytes
+from jltech.bankcb import BankCB
 from jltech.crc import jl_crc16
 from jltech.utils import *
+from jltech.batch import batch_main
+from jltech.report import *
 
+from functools import partial
 from pathlib import Path
 import argparse
 import struct
@@ -20,41 +24,24 @@ ap.add_argument('--dirname', default='{fpath}_unpack',
                 help='Unpack directory name template, default: "%(default)s".'
                      ' ({fpath} refers to the full file path, {fdir} refers to the directory name the file resides in, {fname} refers to the file name)')
 
+ap.add_argument('--jobs', type=int, default=1, metavar='N',
+                help='Unpack the files with N worker processes (0 = one per CPU), each file\'s log going into a .log file named after its unpack directory')
+
+report_add_args(ap)
+
 ap.add_argument('input', type=Path, nargs='+',
                 help='Firmware file(s) to unpack')
 
-args = ap.parse_args()
-
 ###############################################################################
 
 def bankcb_decipher(buff, key=0xFFFF):
-    totalsize = 0
-    hdroff = 0
-    numbanks = 1
-    idx = 0
-
-    while idx < numbanks:
-        jl_enc_cipher(buff, hdroff, 16, key)
-
-        hdr, hcrc = struct.unpack_from('<14sH', buff, hdroff)
-        if jl_crc16(hdr) != hcrc:
-            raise RuntimeError('BankCB header CRC mismatch')
-
-        bankid, size, load, offset, crc = struct.unpack('<HHIIH', hdr)
-        totalsize = max(totalsize, offset + size)
+    bcb = BankCB(buff, 0, key)
 
-        if idx == 0:
-            numbanks = bankid
+    # decipher the bank contents in place, checking the CRC along the way
+    for idx in bcb.decipher_into(buff):
+        log(f'bank {idx}/{bcb[idx].index} CRC mismatch', level=QUIET)
 
-        jl_enc_cipher(buff, offset, size, key)
-
-        if jl_crc16(buff[offset : offset+size]) != crc:
-            print(f'bank {idx}/{bankid} CRC mismatch')
-
-        hdroff += 16
-        idx += 1
-
-    return totalsize, numbanks
+    return bcb.size, len(bcb)
 
 def apu_decipher(buff, key=0xFFFF):
     dkey = jl_enc_cipher(buff, 0, 16, key)
@@ -97,6 +84,7 @@ def syd_dump(file, offset, outdir:Path, hkey=None):
 
     # extract some fields off of it
     lcrc, info1, info2, fcount, ver1, ver2, chiptype = struct.unpack('<HIIIII8s', hdr)
+    event('syd', offset=offset, list_crc=lcrc, info=[info1, info2], count=fcount, version=[ver1, ver2], chiptype=chiptype)
 
     # Read the file entries and check their CRC
     header += file.read(fcount * 32)
@@ -119,7 +107,8 @@ def syd_dump(file, offset, outdir:Path, hkey=None):
         ftype, fresvd, fcrc, foffset, fsize, findex, fname = struct.unpack_from('<BBHIII16s', header, off)
         fname = nulltermstr(fname, encoding='gb2312')
 
-        print(f'-- {ftype:02X}/{fresvd:02X} - {fcrc:04X} - @{foffset:06X} ({fsize}) "{fname}"')
+        log(f'-- {ftype:02X}/{fresvd:02X} - {fcrc:04X} - @{foffset:06X} ({fsize}) "{fname}"')
+        event('syd_entry', name=fname, type=ftype, resvd=fresvd, crc16=fcrc, offset=foffset, size=fsize, index=findex)
 
         outpath = outdir/fname
         dataoffset = offset + foffset
@@ -131,7 +120,7 @@ def syd_dump(file, offset, outdir:Path, hkey=None):
                 syd_dump(file, dataoffset, outpath, hkey)
                 continue
             except Exception as e:
-                print('  [*] failed to parse the nested sydfs:', e)
+                log('  [*] failed to parse the nested sydfs:', e)
                 # in case it already made a directory
                 if outpath.exists():
                     outpath.rmdir()
@@ -148,24 +137,19 @@ def syd_dump(file, offset, outdir:Path, hkey=None):
             apu_decipher(data, key=hkey)
 
         if jl_crc16(data) != fcrc:
-            print('   [*] file CRC mismatch!')
+            log(f'   [*] file CRC mismatch for "{fname}" @{foffset:06X}!', level=QUIET)
 
         outpath.write_bytes(data)
 
-def parse_fw(file, outdir):
-    syd_dump(file, args.offset, outdir, hkey=args.hdrkey)
+def parse_fw(file, outdir, offset=0, hkey=0xFFFF):
+    syd_dump(file, offset, outdir, hkey=hkey)
 
-###############################################################################
-
-for fpath in args.input:
-    print(f'#\n# {fpath}\n#\n')
+def unpack(fpath, outdir, offset=0, hkey=0xFFFF):
+    with open(fpath, 'rb') as f:
+        parse_fw(f, outdir, offset, hkey)
 
-    try:
-        with open(fpath, 'rb') as f:
-            parse_fw(f,
-                Path(args.dirname.format(fpath=fpath, fname=fpath.name, fdir=fpath.parent))
-            )
-    except Exception as e:
-        print('[!]', e)
+###############################################################################
 
-    print()
+if __name__ == '__main__':
+    args = ap.parse_args()
+    batch_main(args, partial(unpack, offset=args.offset, hkey=args.hdrkey), args.input)
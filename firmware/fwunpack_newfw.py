@@ -1,7 +1,10 @@
 from jltech.crc import jl_crc16
-from jltech.cipher import jl_enc_cipher, jl_sfc_cipher, cipher_bytes, cipher_copy
+from jltech.cipher import jl_enc_cipher, sfc_decrypt_region, cipher_bytes, cipher_copy
+from jltech.bankcb import BankCB
 from jltech.chipkeybin import chipkeybin_decode
 from jltech.utils import *
+from jltech.batch import batch_main
+from jltech.report import *
 
 from pathlib import Path
 import struct
@@ -18,11 +21,14 @@ ap.add_argument('--dirname', default='{fpath}_unpack',
                      ' {fdir} is the directory the file resides in and'
                      ' {fname} is just the source file name.')
 
+ap.add_argument('--jobs', type=int, default=1, metavar='N',
+                help='Unpack the files with N worker processes (0 = one per CPU), each file\'s log going into a .log file named after its output directory')
+
+report_add_args(ap)
+
 ap.add_argument('input', type=Path, nargs='+',
                 help='Input firmware files')
 
-args = ap.parse_args()
-
 ###############################################################################
 
 class JLFSEntry:
@@ -60,6 +66,10 @@ class JLFSEntry:
 
         self.name = nulltermstr(ename, 'ascii')
 
+    def info(self):
+        return dict(name=self.name, hdr_off=self.hdr_off, data_crc=self.data_crc, offset=self.offset, size=self.size,
+                    data_offset=self.data_offset, data_size=self.data_size, flags=self.flags, resvd=self.resvd, index=self.index)
+
     def __str__(self):
         return f'<JLFS Entry @{self.hdr_off:08X} - {self.data_crc:04X} @{self.offset:08X}/{self.data_offset:08X} ({self.size:10}/{self.data_size:10}) - {self.flags:02X}/{self.resvd:02X} / {self.index} -- "{self.name}">'
 
@@ -87,7 +97,7 @@ class JLFSIterator:
                 next = align_to(entoff + 32, 32)
                 if self.dec_off < next:
                     num = next - self.dec_off
-                    jl_sfc_cipher(self.buff, self.dec_off, num, self.baseaddr, self.key)
+                    sfc_decrypt_region(self.buff, self.baseaddr, self.key, self.dec_off, num)
                     self.dec_off += num
             else:
                 jl_enc_cipher(self.buff, entoff, 32, self.key)
@@ -112,7 +122,7 @@ class JLFSIterator:
                 # decrypt all the stuff now
                 if self.dec_off < next:
                     num = next - self.dec_off
-                    jl_sfc_cipher(self.buff, self.dec_off, num, self.baseaddr, self.key)
+                    sfc_decrypt_region(self.buff, self.baseaddr, self.key, self.dec_off, num)
                     self.dec_off += num
         else:
             # go to the next entry header
@@ -122,31 +132,9 @@ class JLFSIterator:
 
 #---------------------------------------------------------------------------------------------
 
-#
-# yet another copy of the bankcb descrambling code
-#
 def descramble_bankcb(data, base, key):
-    # same as usual.
-    bankcount = 1
-    index = 0
-
-    while index < bankcount:
-        hdroff = base + index * 16
-        jl_enc_cipher(data, hdroff, 16, key)
-        hdr, hcrc = struct.unpack_from('<14sH', data, hdroff)
-
-        if jl_crc16(hdr) != hcrc:
-            raise ValueError(f'Bank {index} header CRC mismatch.')
-
-        bankid, banksize, bankload, bankoff, bankcrc = struct.unpack('<HHIIH', hdr)
-
-        if index == 0:
-            bankcount = bankid
-
-        # decrypt the bank contents in all of its entirety.
-        jl_enc_cipher(data, base + bankoff, banksize, key)
-
-        index += 1
+    # same as usual, the data CRCs are not of concern here.
+    BankCB(data, base, key).decipher_into(data)
 
 #---------------------------------------------------------------------------------------------
 
@@ -176,7 +164,7 @@ def parse_newfw(info, fw, outdir:Path):
     if baseoff is None:
         raise RuntimeError("Could not locate the base offset of the firmware.")
 
-    print(f'Firmware base is at @{baseoff:X}')
+    log(f'Firmware base is at @{baseoff:X}')
     info['base-offset'] = baseoff
 
     #
@@ -185,13 +173,16 @@ def parse_newfw(info, fw, outdir:Path):
     fhcrc, fburnersz, fvid, fflashsz, ffsver, fblockalign, fresvd, fspecopt, fpid = \
         struct.unpack('<HH4sIBBBB16s', header)
 
-    print(f'  Burner size....: {fburnersz}')
-    print(f'  VID............: {fvid}')
-    print(f'  Flash size.....: ${fflashsz:06X}')
-    print(f'  FS version.....: {ffsver}')
-    print(f'  Block alignment: {fblockalign}')
-    print(f'  Special option.: ${fspecopt:02X}')
-    print(f'  PID............: {fpid}')
+    log(f'  Burner size....: {fburnersz}')
+    log(f'  VID............: {fvid}')
+    log(f'  Flash size.....: ${fflashsz:06X}')
+    log(f'  FS version.....: {ffsver}')
+    log(f'  Block alignment: {fblockalign}')
+    log(f'  Special option.: ${fspecopt:02X}')
+    log(f'  PID............: {fpid}')
+
+    event('flash_header', base=baseoff, burner_size=fburnersz, vid=fvid, flash_size=fflashsz, fs_version=ffsver,
+          block_align=fblockalign, special_opt=fspecopt, pid=fpid)
 
     #------------------------------------------------------------
 
@@ -202,7 +193,8 @@ def parse_newfw(info, fw, outdir:Path):
     topdir.mkdir()
 
     for i, ent in enumerate(JLFSIterator(fw, baseoff, len(header), key=headerkey)):
-        print('(top)', ent)
+        log('(top)', ent)
+        event('jlfs_entry', area='top', **ent.info())
 
         foutpath = topdir/ent.name
 
@@ -240,7 +232,7 @@ def parse_newfw(info, fw, outdir:Path):
             if jl_crc16(ckdata) == ckcrc:
                 # Here's the chipkey!
                 chipkey = chipkeybin_decode(ckdata)
-                print(f'Firmware chipkey from isd_config.ini: {chipkey:04X}')
+                log(f'Firmware chipkey from isd_config.ini: {chipkey:04X}')
 
             # the rest is TODO..
 
@@ -257,7 +249,8 @@ def parse_newfw(info, fw, outdir:Path):
         # on the isd_config.ini file contents parsed above.
         raise RuntimeError('Unknown chipkey.')
 
-    print(f'Using chipkey: ${chipkey:04X}')
+    log(f'Using chipkey: ${chipkey:04X}')
+    event('chipkey', key=chipkey)
     info['chip-key'] = chipkey
 
     #
@@ -273,14 +266,16 @@ def parse_newfw(info, fw, outdir:Path):
 
     for i, ent in enumerate(JLFSIterator(fw, appbase, 0, key=chipkey, sfc=True)):
         if i == 0:
-            print('(App Area Head)', ent)
+            log('(App Area Head)', ent)
+            event('jlfs_entry', area='app_area_head', **ent.info())
 
             # offset field of the app_area_head is the entry point address.
             info['entry-point'] = ent.offset
-            print(f'Entry point address: 0x{ent.offset:X}')
+            log(f'Entry point address: 0x{ent.offset:X}')
 
             for aent in JLFSIterator(fw, ent.hdr_off, ent.data_offset - ent.hdr_off):
-                print('(App)', aent)
+                log('(App)', aent)
+                event('jlfs_entry', area='app', **aent.info())
 
                 if aent.flags & 0x10:
                     # reserved area
@@ -295,7 +290,8 @@ def parse_newfw(info, fw, outdir:Path):
                     appfiles.append(str(fpath.relative_to(outdir)))
 
         else:
-            print('(Res)', ent)
+            log('(Res)', ent)
+            event('jlfs_entry', area='res', **ent.info())
 
             fpath = filesdir / ent.name
 
@@ -317,7 +313,8 @@ def parse_newfw(info, fw, outdir:Path):
                     extradir.mkdir()
 
                     for aent in JLFSIterator(fw, ent.hdr_off, ent.data_offset - ent.hdr_off):
-                        print('====>', aent)
+                        log('====>', aent)
+                        event('jlfs_entry', area=ent.name, **aent.info())
                         fpath = extradir / aent.name
                         fpath.write_bytes(fw[aent.data_offset : aent.data_offset + aent.data_size])
 
@@ -352,8 +349,9 @@ def load_ufw_now(f, header, key=0xffff):
         return None
 
     # if we got there it means that we have a valid ufw file.
-    print('--- UFW file ---')
-    print(f' chip name: "{nulltermstr(chipname, "ascii")}"')
+    log('--- UFW file ---')
+    log(f' chip name: "{nulltermstr(chipname, "ascii")}"')
+    event('ufw', chip_name=nulltermstr(chipname, 'ascii'), entries=numents)
 
     # parse entry data
     for off in range(0x40, headersize, 0x50):
@@ -366,7 +364,7 @@ def load_ufw_now(f, header, key=0xffff):
             f.seek(eoffset + offskew)
             fw = f.read(esize)
             if jl_crc16(fw) != edcrc:
-                print('data crc mismatch but who cares?')
+                log(f'data crc mismatch for "{nulltermstr(ename, "ascii")}" but who cares?', level=QUIET)
             return fw
 
 def load_ufw(f):
@@ -419,10 +417,6 @@ def parsefw(path:Path, outdir:Path):
 
 #---------------------------------------------------------------------------------------------
 
-for path in args.input:
-    print(f'#\n# {path}\n#\n')
-    try:
-        parsefw(path, Path(args.dirname.format(fpath=path, fname=path.name, fdir=path.parent)))
-    except Exception as e:
-        print('[!]',e)
-    print()
+if __name__ == '__main__':
+    args = ap.parse_args()
+    batch_main(args, parsefw, args.input)
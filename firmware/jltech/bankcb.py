@@ -0,0 +1,321 @@
+""" BankCB (bank control block) image reader """
+
+__all__ = [
+    'BankHeader',
+    'BankCB',
+    'bankcb_find_key',
+    'bankcb_extract_file',
+    'bankcb_layout',
+    'bankcb_write'
+]
+
+from jltech.cipher import enc_keystream, enc_prefix_table, EncCipher
+from jltech.verify import crc16_deciphered, map_file_batch
+from jltech.crc import jl_crc16
+from collections import namedtuple
+from functools import partial
+import struct
+import os
+
+#-----------------------------------------------------------------------#
+
+'''
+BankCB layout:
+
+00.0F         = Bank 0 header
+10.1F         = Bank 1 header
+...           = (the bank data follows)
+
+Bank header:
+00.01         = Bank index (for the bank 0 it is the bank count instead)
+02.03         = Bank size
+04.07         = Bank load address
+08.0B         = Bank data offset (from the BankCB start)
+0C.0D         = Bank data CRC16
+0E.0F         = Header CRC16
+
+Every header and every bank data is enciphered with the "ENC" cipher on its own.
+'''
+
+BankHeader = namedtuple('BankHeader', 'index size load offset crc hcrc')
+
+class BankCB:
+    """ Random-access reader of a BankCB image in a buffer (e.g. an mmap),
+        with the header table parsed once and the banks deciphered on demand.
+
+    The key being None means the image isn't enciphered.
+    When inclusive is set, the bank count in the first header is one less than
+    the actual count and the extra header is ignored if it turns out to be invalid.
+    """
+    def __init__(self, buff, base=0, key=0xFFFF, endian='<', inclusive=False):
+        self.buff = buff
+        self.base = base
+        self.key = key
+        self.endian = endian
+        self.headers = []
+        self._cache = {}
+
+        ks = None
+        if key is not None:
+            # every header is deciphered from the beginning of the keystream
+            ks = int.from_bytes(enc_keystream(key, 16), 'little')
+
+        count = 1
+        while len(self.headers) < count:
+            idx = len(self.headers)
+            hdr = self.header_bytes(idx, ks)
+
+            ent = BankHeader(*struct.unpack(endian + 'HHIIHH', hdr))
+            if jl_crc16(hdr[:14]) != ent.hcrc:
+                if inclusive and idx > 0 and idx == count - 1:
+                    break # may be an inclusive bank count
+                raise ValueError('Bank %d header CRC mismatch (at %x)' % (idx, base + idx * 16))
+
+            self.headers.append(ent)
+
+            # the first bank entry defines the total bank count
+            if idx == 0:
+                count = max(1, ent.index + inclusive)
+
+    def header_bytes(self, idx, ks=None):
+        """ Get the deciphered 16-byte header of the bank idx """
+        off = self.base + idx * 16
+        hdr = bytes(self.buff[off : off+16])
+        if len(hdr) != 16:
+            raise ValueError('Bank %d header goes beyond the buffer' % idx)
+
+        if self.key is not None:
+            if ks is None:
+                ks = int.from_bytes(enc_keystream(self.key, 16), 'little')
+            hdr = (int.from_bytes(hdr, 'little') ^ ks).to_bytes(16, 'little')
+
+        return hdr
+
+    def __len__(self):
+        return len(self.headers)
+
+    def __iter__(self):
+        return iter(self.headers)
+
+    def __getitem__(self, idx):
+        return self.headers[idx]
+
+    @property
+    def size(self):
+        """ Size of the image up to the end of the furthest bank """
+        return max(ent.offset + ent.size for ent in self.headers)
+
+    def cipher(self):
+        """ Get a fresh cipher stream for the bank data (None if not enciphered) """
+        return None if self.key is None else EncCipher(self.key)
+
+    def raw(self, idx):
+        """ Get a view on the raw (still enciphered) data of the bank idx """
+        ent = self.headers[idx]
+        off = self.base + ent.offset
+        return memoryview(self.buff)[off : off+ent.size]
+
+    def crc(self, idx, out=None):
+        """ Calculate the CRC16 of the deciphered bank idx data, passing it into out if specified """
+        ent = self.headers[idx]
+        return crc16_deciphered(self.buff, self.base + ent.offset, ent.size, self.cipher(), out)
+
+    def verify(self, idx, out=None):
+        """ Check the bank idx data CRC, passing the deciphered data into out if specified """
+        return self.crc(idx, out) == self.headers[idx].crc
+
+    def data(self, idx, verify=True):
+        """ Get the deciphered data of the bank idx, checking its CRC if requested """
+        if idx not in self._cache:
+            data = bytearray(self.headers[idx].size)
+            ok = self.crc(idx, data) == self.headers[idx].crc
+            self._cache[idx] = bytes(data), ok
+
+        data, ok = self._cache[idx]
+        if verify and not ok:
+            raise ValueError('Bank %d data CRC mismatch' % idx)
+
+        return data
+
+    def decipher_into(self, out):
+        """ Put the deciphered headers and bank data into out at the same offsets as in the buffer
+            (so out may be the buffer itself, after which the reader shouldn't be used on it anymore).
+
+        Returns the list of the banks whose data CRC didn't match.
+        """
+        bad = []
+
+        with memoryview(out) as view:
+            for i in range(len(self.headers)):
+                off = self.base + i * 16
+                view[off : off+16] = self.header_bytes(i)
+
+            for i, ent in enumerate(self.headers):
+                if not self.verify(i, view[self.base + ent.offset:]):
+                    bad.append(i)
+
+        return bad
+
+#-----------------------------------------------------------------------#
+
+def bankcb_find_key(buff, base=0, hint=0xFFFF, endian='<'):
+    """ Find the key of a BankCB image, returning None if no key fits.
+
+    The candidates come from the first bank header CRC, then the bank data CRC is checked
+    for them, starting from the closest ones to the hint key.
+    """
+    # The keystream and the CRC16 are both linear, so for the deciphered header:
+    #   crc(hdr[:14] ^ ks[:14]) ^ hcrc(hdr[14:] ^ ks[14:]) == crc(hdr[:14]) ^ hcrc(hdr[14:]) ^ crc(ks[:14]) ^ hcrc(ks[14:])
+    # which has to be zero; the keystream part is worked out for all keys at once from the 16 basis keys.
+    def crcdiff(data):
+        return jl_crc16(data[:14]) ^ struct.unpack(endian + 'H', data[14:16])[0]
+
+    hdr = bytes(buff[base : base+16])
+    if len(hdr) != 16:
+        return None
+
+    table = enc_prefix_table()
+    basis = [crcdiff(table[(1 << b) * 32 : (1 << b) * 32 + 16]) for b in range(16)]
+
+    diffs = [0] * 0x10000
+    for k in range(1, 0x10000):
+        low = k & -k
+        diffs[k] = diffs[k ^ low] ^ basis[low.bit_length() - 1]
+
+    want = crcdiff(hdr)
+
+    # the bank data read so far, by (offset, size), as many candidates point at the same place
+    spans = {}
+
+    for key in sorted((k for k in range(0x10000) if diffs[k] == want), key=lambda k: k ^ hint):
+        ks = enc_keystream(key, 16)
+        ent = BankHeader(*struct.unpack(endian + 'HHIIHH', bytes(a ^ b for a, b in zip(hdr, ks))))
+
+        off = base + ent.offset
+        if off + ent.size > len(buff):
+            continue
+
+        data = spans.get((off, ent.size))
+        if data is None:
+            data = spans[off, ent.size] = bytes(buff[off : off+ent.size])
+
+        if crc16_deciphered(data, 0, ent.size, EncCipher(key)) == ent.crc:
+            return key
+
+    return None
+
+#-----------------------------------------------------------------------#
+
+def _bankcb_extract_part(base, key, endian, inclusive, buff, files):
+    bcb = BankCB(buff, base, key, endian, inclusive)
+    res = []
+
+    for idx, outpath in files:
+        try:
+            with open(outpath, 'wb') as fout:
+                ok = bcb.verify(idx, fout)
+        except (IndexError, ValueError):
+            ok = False
+
+        if not ok:
+            os.unlink(outpath)
+
+        res.append(ok)
+
+    return res
+
+def bankcb_extract_file(path, files, base=0, key=0xFFFF, endian='<', inclusive=False, workers=None):
+    """ Extract the banks of a BankCB image in a file into separate files,
+        files being a list of (bank index, output path), spread across a pool of worker processes.
+
+    Returns a list of flags telling which of the banks were extracted with a matching CRC
+    (the ones that didn't match are not kept).
+    """
+    return map_file_batch(partial(_bankcb_extract_part, base, key, endian, inclusive), path, files, workers)
+
+#-----------------------------------------------------------------------#
+
+def bankcb_layout(inputs, split=None, maxsize=0xFFFF):
+    """ Lay out the banks for a list of (load address, file path) inputs, the first one being the master bank.
+
+    Returns a list of (load address, file path, offset in the file, size) for every bank.
+    The inputs larger than maxsize are split into consecutive banks of split bytes with consecutive
+    load addresses when split is specified, otherwise a ValueError is raised (before anything gets written).
+    """
+    if split is not None and not 0 < split <= maxsize:
+        raise ValueError(f'The split size shall be within 1..{maxsize} bytes')
+
+    banks = []
+
+    for load, path in inputs:
+        size = os.stat(path).st_size
+
+        if size <= maxsize:
+            banks.append((load, path, 0, size))
+            continue
+
+        if split is None:
+            raise ValueError(f'Bank file "{path}" is too big ({size} bytes), maximum is {maxsize} bytes per bank.')
+
+        for off in range(0, size, split):
+            banks.append((load + off, path, off, min(split, size - off)))
+
+    return banks
+
+def bankcb_write(fout, banks, key=None, endian='<', bufsize=0x10000):
+    """ Write a BankCB image with the banks laid out by bankcb_layout into a binary file,
+        streaming the bank data through a buffer while calculating the CRC on the fly,
+        as well as enciphering everything with key if specified.
+
+    Returns the list of the bank headers.
+    """
+    start = fout.tell()
+    fout.write(bytes(len(banks) * 16))
+
+    ks = None
+    if key is not None:
+        ks = int.from_bytes(enc_keystream(key, 16), 'little')
+
+    headers = []
+    table = bytearray()
+
+    for i, (load, path, off, size) in enumerate(banks):
+        # the master bank has the bank count, other banks have their ID there
+        bankid = len(banks) if i == 0 else i - 1
+
+        dataoff = fout.tell() - start
+        cipher = None if key is None else EncCipher(key)
+        crc = 0
+
+        with open(path, 'rb') as f:
+            f.seek(off)
+
+            left = size
+            while left > 0:
+                chunk = f.read(min(bufsize, left))
+                if not chunk:
+                    raise ValueError(f'Bank file "{path}" got shorter while being read')
+
+                crc = jl_crc16(chunk, crc)
+                if cipher is not None:
+                    chunk = cipher.update(chunk)
+
+                fout.write(chunk)
+                left -= len(chunk)
+
+        hdr = struct.pack(endian + 'HHIIH', bankid, size, load, dataoff, crc)
+        hcrc = jl_crc16(hdr)
+        hdr += struct.pack(endian + 'H', hcrc)
+
+        if ks is not None:
+            hdr = (int.from_bytes(hdr, 'little') ^ ks).to_bytes(16, 'little')
+
+        headers.append(BankHeader(bankid, size, load, dataoff, crc, hcrc))
+        table += hdr
+
+    end = fout.tell()
+    fout.seek(start)
+    fout.write(table)
+    fout.seek(end)
+
+    return headers
@@ -0,0 +1,132 @@
+""" Batch processing of many input files """
+
+__all__ = [
+    'batch_run',
+    'batch_summary',
+    'batch_main'
+]
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from jltech.report import QUIET, report_enabled, report_setup, report_from_args, log, event
+from pathlib import Path
+import contextlib
+import time
+import io
+import os
+
+#-----------------------------------------------------------------------#
+
+def _batch_job(func, path, outdir, logsuffix):
+    try:
+        size = os.path.getsize(path)
+        open(path, 'rb').close()
+    except OSError as e:
+        # don't leave anything behind for an input that isn't there
+        return f'failed: {e}', 0, 0
+
+    buff = io.StringIO()
+    status = 'ok'
+    began = time.perf_counter()
+
+    with contextlib.redirect_stdout(buff):
+        try:
+            func(path, outdir)
+        except Exception as e:
+            log('[!]', e, level=QUIET)
+            status = f'failed: {e}'
+
+    took = time.perf_counter() - began
+
+    try:
+        # next to the unpack directory, so that it can't clash with the unpacked files
+        logpath = Path(outdir)
+        logpath = logpath.with_name(logpath.name + logsuffix)
+        logpath.parent.mkdir(parents=True, exist_ok=True)
+        logpath.write_text(buff.getvalue(), encoding='utf-8', errors='replace')
+    except OSError as e:
+        status += f' (no log: {e})'
+
+    return status, size, took
+
+def batch_run(func, jobs, workers=None, logsuffix='.log', initializer=None, initargs=()):
+    """ Run func(path, outdir) for every (path, outdir) job in a pool of worker processes
+        (set up by initializer(*initargs), if specified), with everything a job prints
+        going into a file named after its outdir plus logsuffix instead.
+
+    Yields (path, outdir, status, input size, seconds taken) as the jobs complete.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    with ProcessPoolExecutor(max(1, min(workers, len(jobs))), initializer=initializer, initargs=initargs) as pool:
+        futures = {pool.submit(_batch_job, func, path, outdir, logsuffix): (path, outdir) for path, outdir in jobs}
+
+        for future in as_completed(futures):
+            path, outdir = futures[future]
+
+            try:
+                status, size, took = future.result()
+            except Exception as e:
+                # e.g. the worker process died
+                status, size, took = f'failed: {e}', 0, 0
+
+            yield path, outdir, status, size, took
+
+def batch_summary(results):
+    """ Print the per-file summary table of the batch_run results as they come
+        (or emit an event for each of them instead), returning the number of the failed ones.
+    """
+    table = report_enabled(QUIET)
+
+    if table:
+        print(f'{"status":<8} {"bytes":>12} {"time":>9}  file')
+
+    count = failed = total = 0
+    began = time.perf_counter()
+
+    for path, outdir, status, size, took in results:
+        count += 1
+        total += size
+
+        if status != 'ok':
+            failed += 1
+
+        if table:
+            print(f'{status.split(":")[0]:<8} {size:>12} {took:>8.3f}s  {path}', flush=True)
+            if status != 'ok':
+                print(f'{"":<8} {status}')
+
+        event('unpacked', path=path, outdir=outdir, status=status, size=size, time=round(took, 6))
+
+    if table:
+        took = time.perf_counter() - began
+        print(f'{count - failed} of {count} files done, {total} bytes in {took:.3f}s')
+
+    return failed
+
+def batch_main(args, func, paths):
+    """ Unpack every path with func(path, outdir), the outdir coming from the args.dirname template,
+        one by one or in a pool of args.jobs worker processes (0 = one per CPU).
+
+    The output follows the -q/-v/--json-events options in args; exits with status 1 if a pooled file failed.
+    """
+    report_setup(*report_from_args(args))
+
+    jobs = [(path, Path(args.dirname.format(fpath=path, fname=path.name, fdir=path.parent)))
+            for path in paths]
+
+    if args.jobs != 1:
+        failed = batch_summary(batch_run(func, jobs, args.jobs if args.jobs > 0 else None,
+                                         initializer=report_setup, initargs=report_from_args(args)))
+        exit(1 if failed else 0)
+
+    for path, outdir in jobs:
+        log(f'#\n# {path}\n#\n')
+        event('file', path=path)
+
+        try:
+            func(path, outdir)
+        except Exception as e:
+            log('[!]', e, level=QUIET)
+
+        log()
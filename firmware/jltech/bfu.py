@@ -0,0 +1,109 @@
+""" BFU (JL_UDFIR) update file maker """
+
+__all__ = [
+    'bfu_header',
+    'bfu_write'
+]
+
+from jltech.crc import jl_crc16
+from jltech.utils import align_by, align_to
+import shutil
+import struct
+import mmap
+import os
+
+#-----------------------------------------------------------------------#
+
+''' BFU format:
+
+00.07 = Magic   "JL_UDFIR"
+08.0B = Header size
+0C.0F = Header CRC16
+
+--- Header contents start there:
+10.13 = Data offset
+14.17 = Data size
+18.1B = Data CRC16
+1C.1F = Loader address
+20.23 = Run address
+24... = File name
+'''
+
+def bfu_header(name, size, crc, load_addr=0, run_addr=0, data_align=0x200):
+    """ Make a BFU header for the data of a given size and CRC16, with the data offset
+        being the header end aligned to data_align.
+
+    Returns the header and the data offset.
+    """
+    if data_align <= 0:
+        raise ValueError('The data alignment shall be greater than zero')
+
+    # the header size doesn't depend on the data offset value, so lay it out first
+    info = name.encode()
+    info += bytes(align_by(20 + len(info), 16))
+    dataoff = align_to(16 + 20 + len(info), data_align)
+
+    hdr = struct.pack('>IIIII', dataoff, size, crc, load_addr, run_addr) + info
+
+    return struct.pack('>8sII', b'JL_UDFIR', len(hdr), jl_crc16(hdr)) + hdr, dataoff
+
+def _file_crc16(f, size, chunksize=0x100000):
+    if size == 0:
+        return jl_crc16(b'')
+
+    crc = 0
+
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        with memoryview(mm) as view:
+            for pos in range(0, size, chunksize):
+                crc = jl_crc16(view[pos : pos+chunksize], crc)
+
+    return crc
+
+def _copy_file(fin, fout, size, dstoff):
+    pos = 0
+
+    try:
+        while pos < size:
+            done = os.copy_file_range(fin.fileno(), fout.fileno(), size - pos, pos, dstoff + pos)
+            if done == 0:
+                break
+            pos += done
+        return
+    except (AttributeError, OSError):
+        # no copy_file_range there, or it doesn't work across these files
+        pass
+
+    fin.seek(pos)
+    fout.seek(dstoff + pos)
+    shutil.copyfileobj(fin, fout)
+
+def bfu_write(inpath, outpath, name, load_addr=0, run_addr=0, data_align=0x200, crccache=None):
+    """ Make a BFU file out of the input file, which is copied in-kernel where possible
+        with the CRC calculated over a mapping of it.
+
+    The CRCs are kept in a crccache dict (if specified) keyed by the file identity,
+    so that the same payload in several BFU files is only gone through once.
+    Returns the header fields (data offset, data size, data CRC).
+    """
+    with open(inpath, 'rb') as fin:
+        st = os.fstat(fin.fileno())
+        ident = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+        if crccache is not None and ident in crccache:
+            crc = crccache[ident]
+        else:
+            crc = _file_crc16(fin, st.st_size)
+            if crccache is not None:
+                crccache[ident] = crc
+
+        hdr, dataoff = bfu_header(name, st.st_size, crc, load_addr, run_addr, data_align)
+
+        with open(outpath, 'wb') as fout:
+            fout.write(hdr)
+            fout.write(bytes(dataoff - len(hdr)))
+            fout.flush()
+
+            _copy_file(fin, fout, st.st_size, dataoff)
+
+    return dataoff, st.st_size, crc
@@ -2,51 +2,558 @@
 
 __all__ = [
     'jl_enc_cipher',
+    'enc_keystream',
+    'enc_prefix_table',
+    'enc_key_solver',
+    'enc_recover_key',
     'jl_crc_cipher',
+    'crc_keystream',
+    'crc_recover_keys',
     'jl_rxgp_cipher',
-    'cipher_bytes'
+    'rxgp_keystream',
+    'rxgp_keystream_file',
+    'jl_sfc_cipher',
+    'sfc_keystream',
+    'sfc_decrypt_region',
+    'EncCipher',
+    'SfcCipher',
+    'CrcCipher',
+    'RxGpCipher',
+    'cipher_file',
+    'cipher_bytes',
+    'cipher_copy',
+    'cipher_into'
 ]
 
-from jltech.crc import jl_crc16
+from jltech.crc import jl_crc16, jl_crc16_table
+from abc import ABC, abstractmethod
+from functools import lru_cache
+from array import array
+import tempfile
+import mmap
+import os
 
 #-----------------------------------------------------------------------#
 
+def _xor_keystream(buff, off, size, ks):
+    """ XOR the keystream into the buffer range, in bulk """
+    if size <= 0:
+        return
+
+    with memoryview(buff) as view:
+        view = view[off : off+size]
+        if len(view) != size:
+            raise IndexError('Cipher range goes beyond the buffer')
+
+        data = int.from_bytes(view, 'little') ^ int.from_bytes(ks, 'little')
+        view[:] = data.to_bytes(size, 'little')
+
+#-----------------------------------------------------------------------#
+
+def _enc_step(key):
+    return ((key << 1) ^ (0x1021 if key & 0x8000 else 0)) & 0xFFFF
+
+# the keystream of up to this many bytes is XORed together from the single-bit keys' ones
+_ENC_BASIS_LEN = 0x1000
+# the full LFSR period (32767 steps at most) is only worth running for this many bytes
+_ENC_CYCLE_MIN = 0x8000
+
+@lru_cache(maxsize=64)
+def _enc_cycle(key):
+    """ Run the ENC LFSR through its full period, giving the keystream and the states """
+    # the LFSR is invertible, thus it always comes back to the starting key
+    states = array('H')
+    k = key
+    while True:
+        states.append(k)
+        k = _enc_step(k)
+        if k == key: break
+
+    return bytes(s & 0xFF for s in states), states
+
+@lru_cache(maxsize=1)
+def _enc_basis():
+    """ Keystreams (as integers) and the LFSR states of the 16 single-bit keys over the first _ENC_BASIS_LEN steps """
+    keystreams, states = [], []
+
+    for b in range(16):
+        st = array('H')
+        k = 1 << b
+        for i in range(_ENC_BASIS_LEN + 1):
+            st.append(k)
+            k = _enc_step(k)
+
+        states.append(st)
+        keystreams.append(int.from_bytes(bytes(s & 0xFF for s in st[:-1]), 'little'))
+
+    return keystreams, states
+
+def _enc_run(key, size, pos=0):
+    """ Get the "ENC" keystream of size bytes at position pos, along with the LFSR state after it """
+    end = pos + size
+
+    if end <= _ENC_BASIS_LEN:
+        # the LFSR is linear, so are its states and the keystream in the key
+        keystreams, states = _enc_basis()
+        ks = state = 0
+        k = key
+        while k:
+            low = k & -k
+            b = low.bit_length() - 1
+            ks ^= keystreams[b]
+            state ^= states[b][end]
+            k ^= low
+
+        ks = (ks >> (pos * 8)) & ((1 << (size * 8)) - 1)
+        return ks.to_bytes(size, 'little'), state
+
+    if pos == 0 and end < _ENC_CYCLE_MIN:
+        # a one-off piece, not long enough for the full period to pay off
+        ks = bytearray(size)
+        for i in range(size):
+            ks[i] = key & 0xFF
+            key = ((key << 1) ^ (0x1021 if key & 0x8000 else 0)) & 0xFFFF
+        return bytes(ks), key
+
+    cycle, states = _enc_cycle(key)
+
+    pos %= len(cycle)
+    reps = (pos + size + len(cycle) - 1) // len(cycle)
+    ks = cycle[pos : pos+size] if reps <= 1 else (cycle * reps)[pos : pos+size]
+
+    return ks, states[(pos + size) % len(states)]
+
+def enc_keystream(key, size, pos=0):
+    """ Get the "ENC" keystream of the specified size, starting at position pos """
+    key &= 0xFFFF
+
+    if pos + size <= 32:
+        # short pieces (e.g. headers) come straight from the prefix table,
+        # as there might be a great many different keys to go through
+        return enc_prefix_table()[key*32 + pos : key*32 + pos + size]
+
+    return _enc_run(key, size, pos)[0]
+
 def jl_enc_cipher(buff, off, size, key=0xFFFF):
     """ JieLi "ENC" cipher """
-    for i in range(size):
-        buff[off+i] ^= key & 0xFF
-        key = ((key << 1) ^ (0x1021 if key & 0x8000 else 0)) & 0xFFFF
+    if size <= 0:
+        return key
+
+    key &= 0xFFFF
+
+    if size <= 32:
+        # too short for anything but the plain LFSR run
+        for i in range(size):
+            buff[off+i] ^= key & 0xFF
+            key = ((key << 1) ^ (0x1021 if key & 0x8000 else 0)) & 0xFFFF
+        return key
+
+    ks, key = _enc_run(key, size)
+    _xor_keystream(buff, off, size, ks)
+
     return key
 
+@lru_cache(maxsize=1)
+def enc_prefix_table():
+    """ First 32 keystream bytes for each of the 65536 "ENC" keys, concatenated (2 MiB) """
+    # the keystream is linear in the key, so everything is XORed together from 16 basis keys
+    basis = [ks & ((1 << 256) - 1) for ks in _enc_basis()[0]]
+
+    table = [0] * 0x10000
+    for k in range(1, 0x10000):
+        low = k & -k
+        table[k] = table[k ^ low] ^ basis[low.bit_length() - 1]
+
+    return b''.join(ks.to_bytes(32, 'little') for ks in table)
+
+_crc_cipher_magic = bytes("孟黎我爱你，玉林", "gb2312")
+
+# keystream generator states of the "CrcDecode" cipher, by the initial CRC value:
+# [keystream so far, CRC state after it, keystream period once it's found]
+_crc_cycles = {}
+_CRC_CYCLES_MAX = 64
+
+def _crc_cycle(crc):
+    """ Keystream generator state of the "CrcDecode" cipher, given the initial CRC value """
+    cycle = _crc_cycles.pop(crc, None)
+    if cycle is None:
+        cycle = [bytearray(), crc, None]
+        if len(_crc_cycles) >= _CRC_CYCLES_MAX:
+            # drop the least recently used one
+            del _crc_cycles[next(iter(_crc_cycles))]
+
+    # (re)insert it as the most recently used one
+    _crc_cycles[crc] = cycle
+    return cycle
+
+def crc_keystream(key, size, pos=0):
+    """ Get the "CrcDecode" keystream of the specified size, starting at position pos """
+    # the keystream only depends on the CRC of the key's upper half
+    init = jl_crc16(int.to_bytes(key >> 16, 2, 'little'), key & 0xffff)
+    cycle = _crc_cycle(init)
+    ks, crc, period = cycle
+
+    # every pass over the magic is a bijection of the CRC state,
+    # so once it comes back to the initial value the keystream repeats
+    while period is None and len(ks) < pos + size:
+        for b in _crc_cipher_magic:
+            crc = ((crc << 8) & 0xFFFF) ^ jl_crc16_table[(crc >> 8) ^ b]
+            ks.append(crc & 0xFF)
+
+        if crc == init:
+            period = len(ks)
+
+    cycle[1:] = crc, period
+
+    if period is None:
+        return bytes(ks[pos : pos+size])
+
+    pos %= period
+    reps = (pos + size + period - 1) // period
+    return (bytes(ks) * reps)[pos : pos+size]
+
+def crc_recover_keys(ks, low=0xFFFF):
+    """ Find the "CrcDecode" keys with the specified lower half that produce the keystream
+        (i.e. ciphertext ^ known plaintext) """
+    # the keystream only depends on the CRC of the upper half with the lower half
+    # being the initial value, and that is a bijection of the upper half; so the keys
+    # with a fixed lower half give every keystream there is, each exactly once.
+    ks = bytes(ks)
+    keys = []
+
+    for high in range(0x10000):
+        crc = jl_crc16(int.to_bytes(high, 2, 'little'), low)
+
+        # reject early on the first few bytes
+        for i in range(min(len(ks), 4)):
+            crc = ((crc << 8) & 0xFFFF) ^ jl_crc16_table[(crc >> 8) ^ _crc_cipher_magic[i]]
+            if (crc & 0xFF) != ks[i]:
+                break
+        else:
+            key = (high << 16) | (low & 0xFFFF)
+            if crc_keystream(key, len(ks)) == ks:
+                keys.append(key)
+
+    return keys
+
 def jl_crc_cipher(buff, off, size, key=0xFFFFFFFF):
     """ JieLi "CrcDecode" cipher """
-    magic = bytes("孟黎我爱你，玉林", "gb2312")
+    _xor_keystream(buff, off, size, crc_keystream(key, size))
 
-    crc = jl_crc16(int.to_bytes(key >> 16, 2, 'little'), key & 0xffff)
+_rxgp_seed = 0x70477852 # "RxGp"
+# the shared keystream cache is kept up to this size, anything further on is generated as needed
+_RXGP_CACHE_MAX = 0x100000
+# [keystream so far, RNG state after it]
+_rxgp_cache = [bytearray(), _rxgp_seed]
+# keystream persisted by rxgp_keystream_file()
+_rxgp_mapped = None
+
+def _rxgp_run(rng, skip, size):
+    """ Skip the RNG ahead, then generate size bytes of the "RxGp" keystream, giving the new RNG state as well """
+    for i in range(skip):
+        rng = (rng * 16807) + (rng // 127773) * -0x7fffffff
+
+    ks = bytearray(size)
     for i in range(size):
-        mi = i % len(magic)
-        crc = jl_crc16(magic[mi:mi+1], crc)
-        buff[off+i] ^= crc & 0xff
+        rng = (rng * 16807) + (rng // 127773) * -0x7fffffff
+        ks[i] = rng & 0xff
+
+    return bytes(ks), rng
+
+def rxgp_keystream(size, pos=0):
+    """ Get the "RxGp" keystream of the specified size, starting at position pos """
+    if _rxgp_mapped is not None and pos + size <= len(_rxgp_mapped):
+        return _rxgp_mapped[pos : pos+size]
+
+    ks, rng = _rxgp_cache
+
+    if len(ks) < min(pos + size, _RXGP_CACHE_MAX):
+        # generate it in 4k pieces, so that the small reads aren't calling there all the time
+        need = min((pos + size + 0xFFF) & ~0xFFF, _RXGP_CACHE_MAX) - len(ks)
+        more, rng = _rxgp_run(rng, 0, need)
+        ks += more
+
+        _rxgp_cache[1] = rng
+
+    if pos + size <= len(ks):
+        return bytes(ks[pos : pos+size])
+
+    # the part beyond the cache
+    head = bytes(ks[pos:])
+    tail, _ = _rxgp_run(rng, max(0, pos - len(ks)), size - len(head))
+
+    return head + tail
+
+def rxgp_keystream_file(path, size):
+    """ Persist at least size bytes of the "RxGp" keystream in a file and use its mapping from now on """
+    global _rxgp_mapped
+
+    if size <= 0:
+        raise ValueError('The keystream size shall be positive')
+
+    # use the existing file if it's long enough and looks like the right thing
+    try:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size >= size:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                head = mm[:4096]
+                if head == rxgp_keystream(len(head)):
+                    _rxgp_mapped = mm
+                    return
+                mm.close()
+    except FileNotFoundError:
+        pass
+
+    # otherwise write a new one aside and swap it in as a whole, so that
+    # the other processes which have the old one mapped keep it intact
+    fd, tmppath = tempfile.mkstemp(prefix=os.path.basename(path) + '.', dir=os.path.dirname(os.path.abspath(path)))
+    mm = None
+
+    try:
+        with os.fdopen(fd, 'w+b') as f:
+            # it's meant to be shared, so give it the usual permissions instead of the private ones
+            umask = os.umask(0)
+            os.umask(umask)
+            os.fchmod(f.fileno(), 0o666 & ~umask)
+
+            f.write(rxgp_keystream(size))
+            f.flush()
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        os.replace(tmppath, path)
+    except BaseException:
+        if mm is not None:
+            mm.close()
+        os.unlink(tmppath)
+        raise
+
+    _rxgp_mapped = mm
 
 def jl_rxgp_cipher(buff, off, size):
     """ JieLi "RxGp" cipher """
-    rng = 0x70477852 # "RxGp"
-    for i in range(size):
-        rng = (rng * 16807) + (rng // 127773) * -0x7fffffff
-        buff[off+i] ^= rng & 0xff
+    _xor_keystream(buff, off, size, rxgp_keystream(size))
+
+@lru_cache(maxsize=1)
+def enc_key_solver():
+    """ Tables for solving the "ENC" key from keystream bytes 0 and 8 """
+    table = enc_prefix_table()
+
+    # byte 0 is the key's lower half, and byte 8 is linear in the whole key,
+    # being a bijection of the upper half when the lower half is zero.
+    lo8 = bytes(table[low*32 + 8] for low in range(256))
+
+    hiinv = bytearray(256)
+    for high in range(256):
+        hiinv[table[(high << 8)*32 + 8]] = high
+
+    return bytes(lo8), bytes(hiinv)
+
+def enc_recover_key(ks):
+    """ Solve the "ENC" key from its keystream (i.e. ciphertext ^ known plaintext, at least 9 bytes of it),
+        returning None if no key produces that keystream """
+    if len(ks) < 9:
+        raise ValueError('At least 9 keystream bytes are needed')
+
+    lo8, hiinv = enc_key_solver()
+    key = (hiinv[ks[8] ^ lo8[ks[0]]] << 8) | ks[0]
+
+    if len(ks) <= 32:
+        expect = enc_prefix_table()[key*32 : key*32 + len(ks)]
+    else:
+        expect = enc_keystream(key, len(ks))
+
+    if expect != bytes(ks):
+        return None
+
+    return key
+
+@lru_cache(maxsize=8)
+def _sfc_addr_keystream(residue):
+    """ Address-derived keystream of the SFC blocks whose key offsets are residue, residue+8, ... """
+    # block n is keyed by adr ^ key, and only the low 16 bits of adr matter,
+    # so the address schedule repeats itself every 8192 blocks (256 KiB)
+    table = memoryview(enc_prefix_table())
+    return b''.join(table[(residue + 8 * j) * 32 : (residue + 8 * j) * 32 + 32] for j in range(0x2000))
+
+def sfc_keystream(key, adr, size):
+    """ Get the SFC keystream for size bytes, with the first 32-byte block being keyed by key ^ adr """
+    nblocks = (size + 31) // 32
+
+    # ENC(key ^ adr) == ENC(key) ^ ENC(adr), thus the chip key
+    # and the address parts can be generated separately
+    addrks = _sfc_addr_keystream(adr & 7)
+    start = ((adr >> 3) & 0x1FFF) * 32
+    reps = (start + nblocks * 32 + len(addrks) - 1) // len(addrks)
+    addrks = (addrks * reps)[start : start + size] if reps > 1 else addrks[start : start + size]
+
+    keyks = enc_keystream(key, 32) * nblocks
+
+    data = int.from_bytes(keyks[:size], 'little') ^ int.from_bytes(addrks, 'little')
+    return data.to_bytes(size, 'little')
+
+def sfc_decrypt_region(buff, base, key, off=None, size=None):
+    """ Decipher (or encipher) the SFC area contents in buff that begins at offset base """
+    if off is None: off = base
+    if size is None: size = len(buff) - off
+
+    if size <= 0:
+        return
+
+    _xor_keystream(buff, off, size, sfc_keystream(key, (off - base) >> 2, size))
 
 def jl_sfc_cipher(buff, off, size, base, key, blocksize=32):
+    """ JieLi SFC cipher (ENC keyed by the address of each block) """
+    if blocksize == 32:
+        sfc_decrypt_region(buff, base, key, off, size)
+        return
+
     for i in range(0, size, blocksize):
         jl_enc_cipher(buff, off + i, min(size - i, blocksize), key ^ ((off + i - base) >> 2))
 
 #-----------------------------------------------------------------------#
 
+class CipherStream(ABC):
+    """ Incremental cipher, carrying its keystream position across the chunks """
+    def __init__(self, pos=0):
+        self.pos = pos
+
+    @abstractmethod
+    def keystream(self, pos, size):
+        """ Get size bytes of the keystream at position pos """
+
+    def update(self, chunk):
+        """ Cipher the next chunk of data, returning the result """
+        size = memoryview(chunk).nbytes
+        ks = self.keystream(self.pos, size)
+        self.pos += size
+
+        data = int.from_bytes(chunk, 'little') ^ int.from_bytes(ks, 'little')
+        return data.to_bytes(size, 'little')
+
+    def update_into(self, src, dst):
+        """ Cipher the next chunk of data from src into dst (which may be the same buffer) """
+        size = memoryview(src).nbytes
+
+        with memoryview(dst) as view:
+            view[:size] = self.update(src)
+
+        return size
+
+class EncCipher(CipherStream):
+    """ Streaming JieLi "ENC" cipher """
+    def __init__(self, key=0xFFFF, pos=0):
+        super().__init__(pos)
+        self.key = key
+
+    def keystream(self, pos, size):
+        return enc_keystream(self.key, size, pos)
+
+class SfcCipher(CipherStream):
+    """ Streaming JieLi SFC cipher, pos being the offset from the area beginning """
+    def __init__(self, key, pos=0):
+        super().__init__(pos)
+        self.key = key
+
+    def keystream(self, pos, size):
+        skip = pos & 31
+        return sfc_keystream(self.key, (pos - skip) >> 2, skip + size)[skip:]
+
+class CrcCipher(CipherStream):
+    """ Streaming JieLi "CrcDecode" cipher """
+    def __init__(self, key=0xFFFFFFFF, pos=0):
+        super().__init__(pos)
+        self.key = key
+
+    def keystream(self, pos, size):
+        return crc_keystream(self.key, size, pos)
+
+class RxGpCipher(CipherStream):
+    """ Streaming JieLi "RxGp" cipher, running its own RNG along the data """
+    def __init__(self, pos=0):
+        super().__init__(pos)
+        # RNG state and the keystream position it's at
+        self.rng = _rxgp_seed
+        self.rngpos = 0
+
+    def keystream(self, pos, size):
+        if _rxgp_mapped is not None and pos + size <= len(_rxgp_mapped):
+            return _rxgp_mapped[pos : pos+size]
+
+        if pos < self.rngpos:
+            self.rng, self.rngpos = _rxgp_seed, 0
+
+        ks, self.rng = _rxgp_run(self.rng, pos - self.rngpos, size)
+        self.rngpos = pos + size
+
+        return ks
+
+def cipher_file(cipher, fin, fout, size=None, bufsize=0x100000):
+    """ Pass size bytes (or everything up to EOF) from fin through the cipher stream into fout """
+    buff = bytearray(bufsize)
+    done = 0
+
+    while size is None or done < size:
+        want = bufsize if size is None else min(bufsize, size - done)
+
+        with memoryview(buff) as view:
+            n = fin.readinto(view[:want])
+            if not n:
+                break
+
+            cipher.update_into(view[:n], view)
+            fout.write(view[:n])
+
+        done += n
+
+    return done
+
+#-----------------------------------------------------------------------#
+
+def _cipher_keystream(func, off, size, args, kvargs):
+    """ Get the keystream that func would apply over size bytes at off, or None if it's unknown """
+    if func is jl_enc_cipher:
+        return (lambda key=0xFFFF: enc_keystream(key, size))(*args, **kvargs)
+    elif func is jl_crc_cipher:
+        return (lambda key=0xFFFFFFFF: crc_keystream(key, size))(*args, **kvargs)
+    elif func is jl_rxgp_cipher:
+        return rxgp_keystream(size)
+    elif func is jl_sfc_cipher:
+        def sfc(base, key, blocksize=32):
+            if blocksize == 32:
+                return sfc_keystream(key, (off - base) >> 2, size)
+        return sfc(*args, **kvargs)
+
+def cipher_into(func, src, dst, *args, **kvargs):
+    """ Cipher the src buffer contents into the dst buffer (which may be the same one) """
+    size = memoryview(src).nbytes
+
+    ks = _cipher_keystream(func, 0, size, args, kvargs)
+    if ks is None:
+        with memoryview(dst) as view:
+            view[:size] = src
+        func(dst, 0, size, *args, **kvargs)
+        return
+
+    data = int.from_bytes(src, 'little') ^ int.from_bytes(ks, 'little')
+    with memoryview(dst) as view:
+        view[:size] = data.to_bytes(size, 'little')
+
 def cipher_bytes(func, data, *args, **kvargs):
-    data = bytearray(data)
-    func(data, 0, len(data), *args, **kvargs)
-    return bytes(data)
+    size = memoryview(data).nbytes
+
+    ks = _cipher_keystream(func, 0, size, args, kvargs)
+    if ks is None:
+        data = bytearray(data)
+        func(data, 0, size, *args, **kvargs)
+        return bytes(data)
+
+    data = int.from_bytes(data, 'little') ^ int.from_bytes(ks, 'little')
+    return data.to_bytes(size, 'little')
 
 def cipher_copy(func, data, off, size, *args, **kvargs):
-    data = bytearray(data[off : off+size])
-    func(data, 0, size, *args, **kvargs)
-    return bytes(data)
+    with memoryview(data) as view:
+        view = view[off : off+size]
+        if len(view) != size:
+            raise IndexError('Cipher range goes beyond the buffer')
+
+        return cipher_bytes(func, view, *args, **kvargs)
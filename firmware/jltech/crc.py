@@ -2,10 +2,102 @@
 
 __all__ = [
     'jl_crc16',
-    'jl_crc32'
+    'jl_crc16_table',
+    'jl_crc32',
+    'crc16_combine',
+    'crc32_combine',
+    'crc16_extend',
+    'crc32_extend'
 ]
 
 import crcmod
 
 jl_crc16 = crcmod.mkCrcFun(0x11021,     initCrc=0x0000,     rev=False)
 jl_crc32 = crcmod.mkCrcFun(0x104C11DB7, initCrc=0x26536734, rev=True)
+
+# byte-wise lookup table for jl_crc16: crc = ((crc << 8) & 0xFFFF) ^ jl_crc16_table[(crc >> 8) ^ byte]
+jl_crc16_table = tuple(jl_crc16(bytes([i])) for i in range(256))
+
+#-----------------------------------------------------------------------#
+
+class _CrcAlgebra:
+    """ Combining and extending the CRC values without going through the data itself """
+    def __init__(self, crcfun, width):
+        self.crcfun = crcfun
+        self.width = width
+        self.init = crcfun(b'')
+
+        # operator for feeding a single zero byte into the CRC register,
+        # it's linear as the values are used as-is for the continuation
+        op = [crcfun(b'\0', 1 << i) for i in range(width)]
+
+        # operators for feeding 2^n zero bytes, made up as needed
+        self.zeros = [op]
+
+    @staticmethod
+    def _apply(op, val):
+        res = 0
+        i = 0
+        while val:
+            if val & 1:
+                res ^= op[i]
+            val >>= 1
+            i += 1
+        return res
+
+    def _square(self, op):
+        return [self._apply(op, v) for v in op]
+
+    def shift(self, crc, length):
+        """ Feed length zero bytes to the CRC register """
+        n = 0
+        while length:
+            if n >= len(self.zeros):
+                self.zeros.append(self._square(self.zeros[-1]))
+            if length & 1:
+                crc = self._apply(self.zeros[n], crc)
+            length >>= 1
+            n += 1
+        return crc
+
+    def fill(self, byte, length):
+        """ CRC register contents after length bytes of value byte, started from zero """
+        # fill(a + b) = shift(fill(a), b) ^ fill(b)
+        res = 0
+        part = self.crcfun(bytes([byte]), 0)
+        n = 0
+        while length:
+            if length & 1:
+                res = self.shift(res, 1 << n) ^ part
+            length >>= 1
+            if length:
+                part = self.shift(part, 1 << n) ^ part
+            n += 1
+        return res
+
+    def combine(self, crc1, crc2, len2):
+        """ CRC of A + B, from the CRC of A, CRC of B and the length of B """
+        return self.shift(crc1 ^ self.init, len2) ^ crc2
+
+    def extend(self, crc, length, fill=0x00):
+        """ CRC of the data with a specified CRC, padded with length bytes of fill value """
+        return self.shift(crc, length) ^ self.fill(fill, length)
+
+_jl_crc16_algebra = _CrcAlgebra(jl_crc16, 16)
+_jl_crc32_algebra = _CrcAlgebra(jl_crc32, 32)
+
+def crc16_combine(crc1, crc2, len2):
+    """ jl_crc16 of the concatenation of two blocks, given their CRCs and the second block length """
+    return _jl_crc16_algebra.combine(crc1, crc2, len2)
+
+def crc32_combine(crc1, crc2, len2):
+    """ jl_crc32 of the concatenation of two blocks, given their CRCs and the second block length """
+    return _jl_crc32_algebra.combine(crc1, crc2, len2)
+
+def crc16_extend(crc, length, fill=0x00):
+    """ jl_crc16 of the data padded with length bytes of fill value (e.g. 0x00 or 0xFF) """
+    return _jl_crc16_algebra.extend(crc, length, fill)
+
+def crc32_extend(crc, length, fill=0x00):
+    """ jl_crc32 of the data padded with length bytes of fill value (e.g. 0x00 or 0xFF) """
+    return _jl_crc32_algebra.extend(crc, length, fill)
@@ -0,0 +1,94 @@
+""" Precomputed "ENC" keystream index for the chipkey recovery """
+
+__all__ = [
+    'keyindex_build',
+    'KeyIndex'
+]
+
+from jltech.cipher import enc_prefix_table
+from bisect import bisect_left
+import struct
+import mmap
+
+#-----------------------------------------------------------------------#
+
+'''
+Index file layout:
+
+00.07         = Magic "JLKSIDX1"
+08.20007      = First 32 keystream bytes of each key, in key order
+20008.60007   = First 4 keystream bytes of each key (big-endian), sorted
+60008.80007   = Keys corresponding to the sorted prefixes (little-endian)
+'''
+
+_magic = b'JLKSIDX1'
+_table_off = len(_magic)
+_prefix_off = _table_off + 0x10000 * 32
+_keys_off = _prefix_off + 0x10000 * 4
+_file_size = _keys_off + 0x10000 * 2
+
+def keyindex_build(path):
+    """ Build the keystream index file """
+    table = enc_prefix_table()
+
+    order = sorted(range(0x10000), key=lambda k: table[k*32 : k*32+4])
+
+    with open(path, 'wb') as f:
+        f.write(_magic)
+        f.write(table)
+        f.write(b''.join(table[k*32 : k*32+4] for k in order))
+        f.write(struct.pack('<65536H', *order))
+
+class _Prefixes:
+    """ Sorted keystream prefixes, as a sequence for bisect """
+    def __init__(self, mm):
+        self.mm = mm
+
+    def __len__(self):
+        return 0x10000
+
+    def __getitem__(self, i):
+        return self.mm[_prefix_off + i*4 : _prefix_off + i*4 + 4]
+
+class KeyIndex:
+    """ Memory-mapped keystream index file """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self.mm) != _file_size or self.mm[:len(_magic)] != _magic:
+            raise ValueError('Not a keystream index file')
+
+        self.prefixes = _Prefixes(self.mm)
+
+    def close(self):
+        self.mm.close()
+
+    def keystream(self, key):
+        """ First 32 keystream bytes of the key """
+        return self.mm[_table_off + key*32 : _table_off + key*32 + 32]
+
+    def lookup(self, ks):
+        """ Find all keys whose keystream begins with ks (at least 4 bytes, at most 32 bytes) """
+        if not 4 <= len(ks) <= 32:
+            raise ValueError('The keystream piece shall be 4 to 32 bytes long')
+
+        ks = bytes(ks)
+        keys = []
+
+        i = bisect_left(self.prefixes, ks[:4])
+        while i < 0x10000 and self.prefixes[i] == ks[:4]:
+            key, = struct.unpack_from('<H', self.mm, _keys_off + i*2)
+            if self.keystream(key)[:len(ks)] == ks:
+                keys.append(key)
+            i += 1
+
+        return keys
+
+    def recover(self, cipher, plain, adr=0):
+        """ Find the chipkeys that turn the ciphertext of an SFC block into the known plaintext,
+            given the address-derived key offset of that block (i.e. its offset in the area >> 2).
+        """
+        n = min(len(cipher), len(plain), 32)
+        ks = bytes(c ^ p for c, p in zip(cipher[:n], plain[:n]))
+        return [key ^ (adr & 0xFFFF) for key in self.lookup(ks)]
@@ -0,0 +1,64 @@
+""" Batch manifest (YAML/JSON) loading """
+
+__all__ = [
+    'manifest_int',
+    'manifest_positive',
+    'load_manifest'
+]
+
+from jltech.utils import anyint
+import yaml
+
+#-----------------------------------------------------------------------#
+
+def manifest_int(val):
+    """ Integer field, either a number or an any-base string (e.g. "0x1000") """
+    if isinstance(val, str):
+        return anyint(val)
+    if isinstance(val, bool) or not isinstance(val, int):
+        raise TypeError(f'{val!r} is not an integer')
+    return val
+
+def manifest_positive(val):
+    """ Integer field that shall be greater than zero """
+    val = manifest_int(val)
+    if val <= 0:
+        raise ValueError(f'{val} is not greater than zero')
+    return val
+
+def load_manifest(path, listkey, fields, what='entry'):
+    """ Load a manifest file, which is either a list of entries or a dict with that list under listkey.
+
+    The fields dict maps each field name to a (conversion function, required) pair;
+    the optional fields that are missing (or null) are left out of the resulting entries.
+    Raises a ValueError describing the first invalid entry.
+    """
+    with open(path) as f:
+        info = yaml.load(f, Loader=yaml.SafeLoader)
+
+    if isinstance(info, dict):
+        info = info.get(listkey)
+
+    if not isinstance(info, list):
+        raise ValueError(f'The manifest should be a list of {listkey}')
+
+    entries = []
+
+    for i, ent in enumerate(info):
+        try:
+            if not isinstance(ent, dict):
+                raise TypeError(f'{ent!r} is not a mapping')
+
+            res = {}
+
+            for field, (conv, required) in fields.items():
+                if ent.get(field) is not None:
+                    res[field] = conv(ent[field])
+                elif required:
+                    raise KeyError(field)
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f'Invalid {what} #{i} in the manifest: {e}')
+
+        entries.append(res)
+
+    return entries
@@ -0,0 +1,78 @@
+""" Output verbosity levels and machine-readable events for the unpackers """
+
+__all__ = [
+    'QUIET',
+    'NORMAL',
+    'VERBOSE',
+    'DEBUG',
+    'report_add_args',
+    'report_from_args',
+    'report_setup',
+    'report_enabled',
+    'log',
+    'dump',
+    'event'
+]
+
+from jltech.utils import hexdump
+import json
+
+#-----------------------------------------------------------------------#
+
+QUIET   = 0     # warnings and errors only
+NORMAL  = 1     # structure info
+VERBOSE = 2     # hexdumps of the small structures (headers, configs, keys)
+DEBUG   = 3     # hexdumps of everything else
+
+_verbosity = NORMAL
+_json_events = False
+
+def report_add_args(ap):
+    """ Add the -q/-v/--json-events options to an argument parser """
+    ap.add_argument('-q', '--quiet', action='store_true',
+                    help='Only print the warnings and errors')
+
+    ap.add_argument('-v', '--verbose', action='count', default=0,
+                    help='Print the hexdumps of the headers and configs (-v), as well as the file contents (-vv)')
+
+    ap.add_argument('--json-events', action='store_true',
+                    help='Instead of the usual output, print one JSON record per line for every parsed structure')
+
+def report_from_args(args):
+    """ Get the report_setup arguments from the parsed options """
+    return (QUIET if args.quiet else NORMAL + args.verbose), args.json_events
+
+def report_setup(verbosity=NORMAL, json_events=False):
+    """ Set the output verbosity level, or switch to the JSON events instead """
+    global _verbosity, _json_events
+    _verbosity = verbosity
+    _json_events = json_events
+
+def report_enabled(level=NORMAL):
+    """ Check whether the output of the given level goes anywhere """
+    return not _json_events and _verbosity >= level
+
+def log(*args, level=NORMAL, **kwargs):
+    """ Print a message of the given level (the QUIET level ones also go as events) """
+    if _json_events:
+        if level <= QUIET:
+            event('message', text=' '.join(str(a) for a in args))
+
+    elif _verbosity >= level:
+        print(*args, **kwargs)
+
+def dump(data, level=VERBOSE, **kwargs):
+    """ Hexdump the data if the given level is enabled (in full at the DEBUG verbosity) """
+    if report_enabled(level):
+        kwargs.setdefault('collapse', _verbosity < DEBUG)
+        hexdump(data, **kwargs)
+
+def _jsonable(obj):
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return bytes(obj).hex()
+    return str(obj)
+
+def event(kind, **fields):
+    """ Emit a single-line JSON record about a parsed structure, if the JSON events are on """
+    if _json_events:
+        print(json.dumps({'event': kind, **fields}, separators=(',', ':'), default=_jsonable))
@@ -0,0 +1,173 @@
+""" SFC area processing over files """
+
+__all__ = [
+    'sfc_rekey_stream',
+    'sfc_recrypt_file',
+    'sfc_recrypt_batch'
+]
+
+from jltech.cipher import sfc_keystream, enc_keystream, CipherStream, SfcCipher
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import shutil
+import time
+import mmap
+import os
+
+#-----------------------------------------------------------------------#
+
+class _SfcRekeyCipher(CipherStream):
+    """ SFC deciphering with one key and enciphering with another in a single pass """
+    def __init__(self, key, pos=0):
+        super().__init__(pos)
+        # ENC(srckey ^ adr) ^ ENC(dstkey ^ adr) == ENC(srckey ^ dstkey),
+        # so the address part cancels out and every block gets the same keystream
+        self.block = enc_keystream(key, 32)
+
+    def keystream(self, pos, size):
+        skip = pos & 31
+        return (self.block * ((skip + size + 31) // 32))[skip : skip+size]
+
+def sfc_rekey_stream(srckey, dstkey, pos=0):
+    """ Cipher stream turning SFC data ciphered with srckey into data ciphered with dstkey,
+        where a negative key means that the data is plain on that side (None if both are) """
+    if srckey >= 0 and dstkey >= 0:
+        return _SfcRekeyCipher(srckey ^ dstkey, pos)
+    elif srckey >= 0:
+        return SfcCipher(srckey, pos)
+    elif dstkey >= 0:
+        return SfcCipher(dstkey, pos)
+
+def _sfc_recrypt_chunk(path, start, srckey, dstkey, off, size, bufsize, progress=None):
+    """ Re-key a piece of the SFC area (beginning at start) within the file in place, through its own shared mapping """
+    cipher = sfc_rekey_stream(srckey, dstkey, off - start)
+
+    with open(path, 'r+b') as f:
+        with mmap.mmap(f.fileno(), 0) as mm:
+            with memoryview(mm) as view:
+                for pos in range(off, off + size, bufsize):
+                    chunk = view[pos : min(pos + bufsize, off + size)]
+                    cipher.update_into(chunk, chunk)
+                    chunk.release()
+
+                    if progress is not None:
+                        progress(min(pos + bufsize, off + size) - off)
+
+            mm.flush()
+
+    return size
+
+def _sfc_recrypt_inplace(path, start, srckey, dstkey, off, size, workers, bufsize, progress=None):
+    """ Re-key a piece of the SFC area (beginning at start) within the file in place, split into chunks
+        of bufsize bytes across a pool of worker processes, unless there's a single worker or a single chunk.
+
+    The progress callback, if specified, gets called with the amount of data done and the total.
+    """
+    if workers <= 1 or size <= bufsize:
+        _sfc_recrypt_chunk(path, start, srckey, dstkey, off, size, bufsize,
+                           None if progress is None else lambda done: progress(done, size))
+        return
+
+    # each block's key only depends on its address, so any
+    # piece made of whole blocks can be done independently
+    chunks = [(coff, min(bufsize, off + size - coff)) for coff in range(off, off + size, bufsize)]
+    done = 0
+
+    # get the keystream tables ready: the forked workers inherit them from here,
+    # and the spawned ones build them in the initializer before taking any chunks
+    warmup = (srckey if srckey >= 0 else dstkey, (off - start) >> 2, 32)
+    sfc_keystream(*warmup)
+
+    with ProcessPoolExecutor(workers, initializer=sfc_keystream, initargs=warmup) as pool:
+        jobs = [pool.submit(_sfc_recrypt_chunk, path, start, srckey, dstkey, coff, csize, bufsize)
+                    for coff, csize in chunks]
+
+        for job in as_completed(jobs):
+            done += job.result()
+            if progress is not None:
+                progress(done, size)
+
+def sfc_recrypt_file(inpath, outpath, start, end, srckey, dstkey, workers=1, bufsize=0x100000, progress=None):
+    """ Re-key the SFC area between start and end (exclusive) from srckey to dstkey (negative key = plain),
+        copying the rest of the input file as-is.
+
+    When the input and output are the same file, it's done in place through a mapping of the file;
+    otherwise the data is streamed through a buffer of bufsize bytes.
+    With more than one worker, the output file is re-keyed in place by a pool of processes.
+
+    The progress callback, if specified, gets called with the amount of area data done and the total.
+    Returns the size of the area.
+    """
+    fsize = os.path.getsize(inpath)
+    start = max(0, min(start, fsize))
+    end = max(start, min(end, fsize))
+    total = end - start
+
+    inplace = os.path.exists(outpath) and os.path.samefile(inpath, outpath)
+    bufsize = max(32, bufsize & ~31)
+
+    if sfc_rekey_stream(srckey, dstkey) is None:
+        total = 0
+
+    if not inplace and (workers > 1 or total == 0):
+        shutil.copyfile(inpath, outpath)
+        inplace = True
+
+    if total == 0:
+        return end - start
+
+    if inplace:
+        _sfc_recrypt_inplace(outpath, start, srckey, dstkey, start, total, workers, bufsize, progress)
+
+    else:
+        cipher = sfc_rekey_stream(srckey, dstkey)
+        buff = bytearray(bufsize)
+
+        with open(inpath, 'rb') as fin, open(outpath, 'wb') as fout:
+            # everything before the area
+            remain = start
+            while remain > 0:
+                remain -= fout.write(fin.read(min(remain, bufsize)))
+
+            # the area itself
+            with memoryview(buff) as view:
+                for off in range(start, end, bufsize):
+                    n = fin.readinto(view[:min(bufsize, end - off)])
+                    cipher.update_into(view[:n], view)
+                    fout.write(view[:n])
+
+                    if progress is not None:
+                        progress(off + n - start, total)
+
+            # and everything after
+            shutil.copyfileobj(fin, fout, bufsize)
+
+    return total
+
+def _sfc_recrypt_job(job, bufsize):
+    began = time.perf_counter()
+
+    try:
+        size = sfc_recrypt_file(job['input'], job['output'], job['start'], job['end'],
+                                job['srckey'], job['dstkey'], bufsize=bufsize)
+        error = None
+    except Exception as e:
+        size = 0
+        error = str(e)
+
+    return size, time.perf_counter() - began, error
+
+def sfc_recrypt_batch(jobs, workers=None, bufsize=0x100000):
+    """ Run a batch of re-keying jobs (dicts with the sfc_recrypt_file arguments: input, output,
+        start, end, srckey and dstkey) through a pool of worker processes, each job being streamed
+        through its own buffer.
+
+    Yields (job, area size, seconds taken, error message or None) as the jobs complete.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    with ProcessPoolExecutor(max(1, min(workers, len(jobs)))) as pool:
+        futures = {pool.submit(_sfc_recrypt_job, job, bufsize): job for job in jobs}
+
+        for future in as_completed(futures):
+            yield (futures[future], *future.result())
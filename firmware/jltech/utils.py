@@ -8,35 +8,70 @@ __all__ = [
     'nulltermstr'
 ]
 
-def hexdump(data, width=16, off=0, size=None, base=0):
+import sys
+
+# text column translation: control characters are shown as dots
+_hexdump_table = bytes(ord('.') if b < 0x20 else b for b in range(256))
+
+def hexdump(data, width=16, off=0, size=None, base=0, file=None, collapse=True, batch=0x1000):
+    """ Dump the data in the hex + text form into a text stream (stdout by default),
+        in batches of lines, with the runs of identical lines collapsed into a '*' when requested.
+    """
+    if file is None: file = sys.stdout
     if size is None: size = len(data) - off
-    for off in range(off, off+size, width):
-        line = data[off:off+width]
-
-        #
-        # Make a hex line
-        #
-        hexline = ''
-        for i in range(width):
-            if (i % 8) == 0:
-                hexline += ' '
-
-            if i >= len(line):
-                hexline += '-- '
-            else:
-                hexline += '%02x ' % line[i]
-
-        #
-        # Make a text line
-        #
-        line = bytearray(line + (b' ' * (width - len(line))))
-        for i, b in enumerate(line):
-            if b < 0x20: # or b >= 0x7F:
-                line[i] = ord('.')
-
-        txtline = line.decode('1251', errors='replace')  # 1251 rocks!
-
-        print('%08x:%s %s' % (off+base, hexline, txtline))
+
+    with memoryview(data) as view:
+        # the lines are always whole, as long as there are data for them
+        view = view.cast('B')[off : off + -(-size // width) * width]
+        size = len(view)
+
+        # hex column pieces for the 8-byte groups ('xx ' per byte)
+        groups = [(g * 3, min(g + 8, width) * 3) for g in range(0, width, 8)]
+        prev = None
+        skipping = False
+
+        for start in range(0, size, width * batch):
+            chunk = bytes(view[start : start + width * batch])
+
+            # the whole batch at once (1251 rocks!)
+            hexs = chunk.hex(' ') + ' '
+            text = chunk.translate(_hexdump_table).decode('1251', errors='replace')
+
+            rows = range(0, len(chunk), width)
+            lines = []
+
+            if collapse:
+                # the last line is always there to tell where the data ends
+                same = [chunk[pos : pos+width] == chunk[pos-width : pos] for pos in rows]
+                same[0] = chunk[:width] == prev
+                if start + len(chunk) >= size:
+                    same[-1] = False
+                prev = chunk[rows[-1]:]
+
+            for i, pos in enumerate(rows):
+                if collapse and same[i]:
+                    if not skipping:
+                        lines.append('*')
+                        skipping = True
+                    continue
+
+                skipping = False
+
+                b = pos * 3
+                if pos + width <= len(chunk):
+                    if len(groups) == 2:
+                        # the usual 16-byte lines
+                        hexline = ' ' + hexs[b : b+24] + ' ' + hexs[b+24 : b+width*3]
+                    else:
+                        hexline = ''.join([' ' + hexs[b+x : b+y] for x, y in groups])
+                else:
+                    # the last partial line, padded
+                    hexline = ''.join([' ' + hexs[b+x : b+y].ljust(y - x, '-').replace('---', '-- ') for x, y in groups])
+
+                lines.append('%08x:%s %s' % (off + start + pos + base, hexline, text[pos : pos+width].ljust(width)))
+
+            if lines:
+                file.write('\n'.join(lines) + '\n')
 
 def anyint(s):
     """ Any-base string to integer conversion """
@@ -0,0 +1,108 @@
+""" Integrity checking routines """
+
+__all__ = [
+    'crc16_deciphered',
+    'verify_crc16',
+    'verify_crc16_batch',
+    'verify_crc16_file',
+    'map_file_batch'
+]
+
+from jltech.crc import jl_crc16
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import mmap
+import os
+
+#-----------------------------------------------------------------------#
+
+def crc16_deciphered(buff, off, size, cipher=None, out=None, chunksize=0x10000):
+    """ Calculate the CRC16 of the data in buff deciphered by a cipher stream (e.g. EncCipher(key)),
+        on the fly, leaving buff intact.
+
+    When out is specified (a writable buffer or a binary file), the deciphered data goes there as well.
+    """
+    crc = 0
+
+    with memoryview(buff) as view:
+        view = view[off : off+size]
+        if len(view) != size:
+            raise IndexError('Data range goes beyond the buffer')
+
+        for pos in range(0, size, chunksize):
+            chunk = view[pos : pos+chunksize]
+
+            if cipher is not None:
+                chunk = cipher.update(chunk)
+
+            crc = jl_crc16(chunk, crc)
+
+            if out is None:
+                pass
+            elif hasattr(out, 'write'):
+                out.write(chunk)
+            else:
+                with memoryview(out) as oview:
+                    oview[pos : pos+len(chunk)] = chunk
+
+    return crc
+
+def verify_crc16(buff, off, size, expected, cipher=None, out=None):
+    """ Check the CRC16 of the deciphered data in buff against the expected value """
+    return crc16_deciphered(buff, off, size, cipher, out) == expected
+
+def verify_crc16_batch(buff, entries):
+    """ Verify a batch of (offset, length, expected_crc, cipher) entries against buff,
+        where cipher makes the cipher stream for the entry data (e.g. EncCipher or
+        partial(EncCipher, key)), or is None for plain data.
+
+    Returns a bytearray with 1 for every entry that matches, and 0 for every entry
+    that does not (including the ones that go beyond the buffer).
+    """
+    res = bytearray(len(entries))
+
+    for i, (off, size, expected, cipher) in enumerate(entries):
+        if off < 0 or off + size > len(buff):
+            continue
+
+        # every entry gets its own stream, starting from the beginning of the keystream
+        res[i] = crc16_deciphered(buff, off, size, None if cipher is None else cipher()) == expected
+
+    return res
+
+def _map_file_part(func, path, entries):
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return func(mm, entries)
+
+def map_file_batch(func, path, entries, workers=None):
+    """ Run func(mapping, entries) over a read-only mapping of the file, splitting the entries
+        into contiguous runs across a pool of worker processes.
+
+    The func results for the runs (sequences, e.g. one item per entry) are returned concatenated.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if workers <= 1 or len(entries) < 2:
+        return _map_file_part(func, path, entries)
+
+    # the CRC code keeps holding the GIL, so it's the processes that go in parallel,
+    # each with its own mapping of the image and a contiguous run of the entries.
+    step = (len(entries) + workers - 1) // workers
+
+    with ProcessPoolExecutor(workers) as pool:
+        parts = list(pool.map(partial(_map_file_part, func, path),
+                              [entries[i : i+step] for i in range(0, len(entries), step)]))
+
+    res = parts[0]
+    for part in parts[1:]:
+        res += part
+
+    return res
+
+def verify_crc16_file(path, entries, workers=None):
+    """ Verify a batch of entries (see verify_crc16_batch) against a memory-mapped image file,
+        spreading them across a pool of worker processes.
+    """
+    return map_file_batch(verify_crc16_batch, path, entries, workers)
@@ -1,8 +1,7 @@
-from jltech.crc import jl_crc16
+from jltech.bankcb import bankcb_layout, bankcb_write
 from jltech.utils import *
 
 import argparse
-import struct
 import os
 
 ###############################################################################
@@ -12,6 +11,15 @@ ap = argparse.ArgumentParser(description='Make a BankCB image')
 ap.add_argument('-B', dest='endian', const='>', default='<', action='store_const',
                 help='Encode bank header data in big-endian instead of little-endian default')
 
+ap.add_argument('--split', action='store_true',
+                help='Split the bank files bigger than 0xFFFF bytes into several banks with consecutive load addresses')
+
+ap.add_argument('--split-size', type=anyint, default=0x8000, metavar='SIZE',
+                help='Size of the banks the big files are split into (default: 0x8000)')
+
+ap.add_argument('--key', type=anyint,
+                help='Encrypt the image with a specified key (e.g. 0xFFFF)')
+
 ap.add_argument('output',
                 help='Output file path')
 
@@ -46,42 +54,14 @@ for i in range(0, len(args.input), 2):
 
 ###############################################################################
 
-with open(args.output, 'wb') as f:
-    bank_hdr_fmt  = args.endian + '14sH'
-    bank_hdrc_fmt = args.endian + 'HHIIH'
-    bank_max_size = 0xffff
-    bank_hdr_size = struct.calcsize(bank_hdr_fmt)
-
-    #----------------------------------------------------
-
-    headers = bytearray(len(banks) * bank_hdr_size)
-
-    f.seek(len(headers))
+try:
+    layout = bankcb_layout(banks, split=args.split_size if args.split else None)
+except ValueError as e:
+    print(e)
+    exit(1)
 
-    for i, (bload, bfile) in enumerate(banks):
-        if i == 0:
-            # master bank has the bank count
-            bankid = len(banks)
-        else:
-            # other banks have their ID there
-            bankid = i - 1
-
-        with open(bfile, 'rb') as bf:
-            data = bf.read()
-
-        if len(data) > bank_max_size:
-            print(f'Bank {i} is too big ({len(data)} bytes), maximum is {bank_max_size} bytes per bank.')
-            break
-
-        dataoff = f.tell()
-        datacrc = jl_crc16(data)
-
-        f.write(data)
-
-        print(f'[{i}]: {bankid} - load @{bload:X}, data @{dataoff:X} - {len(data)} bytes, CRC: ${datacrc:04X}')
-
-        hdr = struct.pack(bank_hdrc_fmt, bankid, len(data), bload, dataoff, datacrc)
-        struct.pack_into(bank_hdr_fmt, headers, i * bank_hdr_size, hdr, jl_crc16(hdr))
+with open(args.output, 'wb') as f:
+    headers = bankcb_write(f, layout, key=args.key, endian=args.endian)
 
-    f.seek(0)
-    f.write(headers)
+for i, ent in enumerate(headers):
+    print(f'[{i}]: {ent.index} - load @{ent.load:X}, data @{ent.offset:X} - {ent.size} bytes, CRC: ${ent.crc:04X}')
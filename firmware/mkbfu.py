@@ -1,9 +1,16 @@
-from jltech.crc import jl_crc16
-from jltech.utils import align_by, anyint
-import struct, argparse, os
+from jltech.bfu import bfu_write
+from jltech.manifest import load_manifest, manifest_int, manifest_positive
+from jltech.utils import anyint
+import argparse, os
 
 ################################################################################
 
+def alignment(s):
+    val = anyint(s)
+    if val <= 0:
+        raise ValueError('The alignment shall be greater than zero')
+    return val
+
 ap = argparse.ArgumentParser(description='Jieli UpDate FIRmware / BFU file generator')
 
 ap.add_argument('--load-addr', default=0, type=anyint, metavar='ADDR',
@@ -15,53 +22,58 @@ ap.add_argument('--run-addr', default=0, type=anyint, metavar='ADDR',
 ap.add_argument('--name',
                 help='File name specified in the BFU file (uses uppercase input file name if not specified)')
 
-ap.add_argument('input',
+ap.add_argument('--data-align', default=0x200, type=alignment, metavar='N',
+                help='Alignment of the data offset (the data is placed after the header aligned to that)')
+
+ap.add_argument('--manifest', metavar='FILE',
+                help='Make several BFU files described in a YAML/JSON file (a list of input, output, name, load_addr, run_addr, data_align entries)')
+
+ap.add_argument('input', nargs='?',
                 help='Input binary file')
 
-ap.add_argument('output',
+ap.add_argument('output', nargs='?',
                 help='Output BFU file')
 
-args = ap.parse_args()
-
 ################################################################################
 
-
-''' BFU format:
-
-00.07 = Magic   "JL_UDFIR"
-08.0B = Header size
-0C.0F = Header CRC16
-
---- Header contents start there:
-10.13 = Data offset
-14.17 = Data size
-18.1B = Data CRC16
-1C.1F = Loader address
-20.23 = Run address
-24... = File name
-'''
-
-with open(args.input, 'rb') as f:
-    idata = f.read()
-
-with open(args.output, 'wb') as f:
-    dataoff = 0x200 # TODO
-
-    if args.name is not None:
-        name = args.name
+def load_targets(path):
+    return load_manifest(path, 'targets', {
+        'input':        (str, True),
+        'output':       (str, True),
+        'name':         (str, False),
+        'load_addr':    (manifest_int, False),
+        'run_addr':     (manifest_int, False),
+        'data_align':   (manifest_positive, False),
+    }, 'target')
+
+def make(target, crccache=None, load_addr=0, run_addr=0, data_align=0x200):
+    """ Make the BFU file for a target, the fields it doesn't specify taking the values passed in here """
+    name = target.get('name')
+    if name is None:
+        name = os.path.basename(target['input']).upper()
+
+    dataoff, size, crc = bfu_write(target['input'], target['output'], name,
+                                   load_addr=target.get('load_addr', load_addr),
+                                   run_addr=target.get('run_addr', run_addr),
+                                   data_align=target.get('data_align', data_align),
+                                   crccache=crccache)
+
+    print(f'{target["output"]}: "{name}" - data @{dataoff:X} - {size} bytes, CRC: ${crc:04X}')
+
+if __name__ == '__main__':
+    args = ap.parse_args()
+
+    if args.manifest is not None:
+        try:
+            targets = load_targets(args.manifest)
+        except ValueError as e:
+            ap.error(str(e))
+    elif args.input is None or args.output is None:
+        ap.error('input and output are required without --manifest')
     else:
-        name = os.path.basename(args.input).upper()
-
-    hdr = struct.pack('>IIIII',
-                        dataoff, len(idata),
-                        jl_crc16(idata),
-                        args.load_addr, args.run_addr
-    )
+        targets = [{'input': args.input, 'output': args.output, 'name': args.name}]
 
-    hdr += name.encode()
-    hdr += bytes(align_by(len(hdr), 16))
+    crccache = {}
 
-    f.write(struct.pack('>8sII', b'JL_UDFIR', len(hdr), jl_crc16(hdr)))
-    f.write(hdr)
-    f.seek(dataoff)
-    f.write(idata)
+    for target in targets:
+        make(target, crccache, args.load_addr, args.run_addr, args.data_align)
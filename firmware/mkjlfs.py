@@ -1,4 +1,4 @@
-from jltech.crc import jl_crc16
+from jltech.crc import jl_crc16, crc16_combine, crc16_extend
 from jltech.utils import *
 
 import argparse
@@ -56,6 +56,7 @@ class JLFSmaker:
         self.base = base
         self.align = align
         self.entries = []
+        self.crc16 = None   # CRC of the last bytes() result
 
     def append(self, name, attr, data):
         self.entries.append((name, attr, data))
@@ -76,6 +77,7 @@ class JLFSmaker:
     def __bytes__(self):
         hdata = b''
         odata = b''
+        ocrc = 0
 
         # offset to data
         doffset = self.base + align_to(len(self.entries) * 32, self.align)
@@ -85,16 +87,23 @@ class JLFSmaker:
                 # adjust the base address
                 data.base = doffset
 
-            if isinstance(data, Path):
-                data = data.read_bytes()
-            elif not isinstance(data, (bytes, bytearray)):
-                data = bytes(data)
+                # the nested directory has already got its CRC calculated
+                blob = bytes(data)
+                dcrc = data.crc16
+                data = blob
+            else:
+                if isinstance(data, Path):
+                    data = data.read_bytes()
+                elif not isinstance(data, (bytes, bytearray)):
+                    data = bytes(data)
+
+                dcrc = jl_crc16(data)
 
             print(f'-- {name} @{doffset:08X} ({len(data)}) == {attr:02X}')
 
 
             header = struct.pack('<HIIBBH16s', 
-                                 jl_crc16(data), 
+                                 dcrc, 
                                  doffset,
                                  len(data),
                                  attr, 0xff,
@@ -107,10 +116,16 @@ class JLFSmaker:
             odata += data
             odata += b'\xff' * align_by(len(data), self.align)
 
+            ocrc = crc16_combine(ocrc, dcrc, len(data))
+            ocrc = crc16_extend(ocrc, align_by(len(data), self.align), 0xff)
+
             doffset += align_to(len(data), self.align)
 
         hdata += b'\xff' * align_by(len(hdata), self.align)
 
+        # derive the CRC of the whole thing from the CRCs of its parts
+        self.crc16 = crc16_combine(jl_crc16(hdata), ocrc, len(odata))
+
         return hdata + odata
 
 class JLFSdaisychain:
@@ -144,13 +159,19 @@ class JLFSdaisychain:
             if isinstance(data, JLFSmaker):
                 data.base = 32 # always relative to the header
 
-            if isinstance(data, Path):
-                data = data.read_bytes()
-            elif not isinstance(data, (bytes, bytearray)):
-                data = bytes(data)
+                blob = bytes(data)
+                dcrc = data.crc16
+                data = blob
+            else:
+                if isinstance(data, Path):
+                    data = data.read_bytes()
+                elif not isinstance(data, (bytes, bytearray)):
+                    data = bytes(data)
+
+                dcrc = jl_crc16(data)
 
             header = struct.pack('<HIIBBH16s', 
-                                 jl_crc16(data), 
+                                 dcrc, 
                                  self.first_offset if i == 0 else self.offset,
                                  len(data) + 32,
                                  attr, 0xff,
@@ -0,0 +1,15 @@
+from jltech.keyindex import keyindex_build
+import argparse
+
+################################################################################
+
+ap = argparse.ArgumentParser(description='Build the ENC keystream index used for the chipkey recovery')
+
+ap.add_argument('output',
+                help='Output index file')
+
+args = ap.parse_args()
+
+################################################################################
+
+keyindex_build(args.output)
@@ -1,42 +1,90 @@
-from jltech.cipher import jl_enc_cipher
+from jltech.sfc import sfc_recrypt_file, sfc_recrypt_batch
+from jltech.manifest import load_manifest, manifest_int
 from jltech.utils import anyint
 import argparse
+import sys
+import os
 
 ###############################################################################
 
 ap = argparse.ArgumentParser(description='JieLi SFC data [en/re/de]cipherer')
 
-ap.add_argument('input',
+ap.add_argument('--jobs', type=int, default=1, metavar='N',
+                help='Process the area with N worker processes over the mapped output file, 0 means one per CPU (default: %(default)d)')
+
+ap.add_argument('--progress', action='store_true',
+                help='Report the progress')
+
+ap.add_argument('--manifest', metavar='FILE',
+                help='Run a batch of jobs described in a YAML/JSON file (a list of input, output, srckey, dstkey, start, end entries), '
+                     'with --jobs being the number of files processed in parallel')
+
+ap.add_argument('input', nargs='?',
                 help='Input file')
 
-ap.add_argument('output',
+ap.add_argument('output', nargs='?',
                 help='Output file')
 
-ap.add_argument('srckey', type=anyint,
+ap.add_argument('srckey', type=anyint, nargs='?',
                 help="Input file's key (e.g. 0xffff), anything less than zero means no decryption is done")
 
-ap.add_argument('dstkey', type=anyint,
+ap.add_argument('dstkey', type=anyint, nargs='?',
                 help="Output file's key (e.g. your chip's chipkey), anything less than zero means no encryption is done")
 
-ap.add_argument('start', type=anyint,
+ap.add_argument('start', type=anyint, nargs='?',
                 help="Encrypted data start (i.e. start of the app_dir_head, user.app, etc)")
 
-ap.add_argument('end', type=anyint,
+ap.add_argument('end', type=anyint, nargs='?',
                 help="Encrypted data end (i.e. end of the encrypted blob), note that this is *inclusive*.")
 
-args = ap.parse_args()
-
 ###############################################################################
 
-with open(args.input, 'rb') as f:
-    data = bytearray(f.read())
+def report(done, total):
+    print(f'\r{done}/{total} bytes ({done * 100 // total}%)', end='', file=sys.stderr, flush=True)
+
+def load_jobs(path):
+    return load_manifest(path, 'jobs', {
+        'input':    (str, True),
+        'output':   (str, True),
+        'srckey':   (manifest_int, True),
+        'dstkey':   (manifest_int, True),
+        'start':    (manifest_int, True),
+        'end':      (manifest_int, True),
+    }, 'job')
+
+if __name__ == '__main__':
+    args = ap.parse_args()
+
+    workers = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+
+    if args.manifest is not None:
+        try:
+            jobs = load_jobs(args.manifest)
+        except ValueError as e:
+            ap.error(str(e))
+
+        total_size = 0
+        total_time = 0
+        failed = 0
+
+        for job, size, took, error in sfc_recrypt_batch(jobs, workers):
+            if error is not None:
+                print(f'[!] {job["input"]} -> {job["output"]}: {error}')
+                failed += 1
+                continue
+
+            print(f'{job["input"]} -> {job["output"]}: {size} bytes in {took:.3f}s ({size / max(took, 1e-9) / 1e6:.1f} MB/s)')
+            total_size += size
+            total_time += took
+
+        print(f'{len(jobs) - failed} of {len(jobs)} jobs done, {total_size} bytes in {total_time:.3f}s of worker time')
+        exit(1 if failed else 0)
 
-for off in range(args.start, args.end, 32):
-    size = min(32, args.end - off)
-    adr = (off - args.start) >> 2
+    if None in (args.input, args.output, args.srckey, args.dstkey, args.start, args.end):
+        ap.error('input, output, srckey, dstkey, start and end are required without --manifest')
 
-    if args.srckey >= 0: jl_enc_cipher(data, off, size, args.srckey ^ adr)
-    if args.dstkey >= 0: jl_enc_cipher(data, off, size, args.dstkey ^ adr)
+    sfc_recrypt_file(args.input, args.output, args.start, args.end, args.srckey, args.dstkey,
+                     workers=workers, progress=report if args.progress else None)
 
-with open(args.output, 'wb') as f:
-    f.write(data)
+    if args.progress:
+        print(file=sys.stderr)
@@ -1,4 +1,4 @@
-from jltech.crc import jl_crc16
+from jltech.crc import jl_crc16, crc16_combine, crc16_extend
 import argparse, struct, pathlib
 import yaml
 
@@ -51,6 +51,7 @@ class Sydv2maker:
         self.alignment = alignment
 
         self.files = []
+        self.crc16 = None   # CRC of the last dump() result
 
     def add(self, name, data, flag=0x82):
         info = {'name': name, 'data': data, 'flag': flag}
@@ -91,6 +92,7 @@ class Sydv2maker:
     def dump(self, offbase=0, inclhdrsz=False):
         hdrdata = b''
         fdata = b''
+        fcrc = 0
 
         hdrsize = len(self.files) * 32
         off = offbase + hdrsize
@@ -98,13 +100,19 @@ class Sydv2maker:
         for i, file in enumerate(self.files):
             data = file['data']
 
-            if isinstance(data, pathlib.Path):
-                data = data.read_bytes()
-            elif isinstance(data, Sydv2maker):
-                data = data.dump(offbase=off)
+            if isinstance(data, Sydv2maker):
+                # the nested directory has already got its CRC calculated
+                blob = data.dump(offbase=off)
+                dcrc = data.crc16
+                data = blob
+            else:
+                if isinstance(data, pathlib.Path):
+                    data = data.read_bytes()
+
+                dcrc = jl_crc16(data)
 
             hdr = struct.pack('<HIIBBH16s',
-                            jl_crc16(data), off, len(data) + (hdrsize if inclhdrsz else 0), # TODO! that's bad
+                            dcrc, off, len(data) + (hdrsize if inclhdrsz else 0), # TODO! that's bad
                             file['flag'], 0xff, 1 if (i + 1) == len(self.files) else 0,
                             bytes(file['name'], 'ascii'))
  
@@ -113,8 +121,14 @@ class Sydv2maker:
             fdata += data
             fdata += b'\xff' * (file['alsize'] - len(data))
 
+            fcrc = crc16_combine(fcrc, dcrc, len(data))
+            fcrc = crc16_extend(fcrc, file['alsize'] - len(data), 0xff)
+
             off += file['alsize']
 
+        # derive the CRC of the whole thing from the CRCs of its parts
+        self.crc16 = crc16_combine(jl_crc16(hdrdata), fcrc, len(fdata))
+
         return hdrdata + fdata
 
 ###################################################################################################